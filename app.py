@@ -1,114 +1,123 @@
 import streamlit as st
+import logging
 import os
 import sys
-import socket
-from typing import List, Dict, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import List, Dict, Iterator
 
-print("=" * 50, file=sys.stderr)
-print("STARTUP DEBUG: app.py loading...", file=sys.stderr)
-print("=" * 50, file=sys.stderr)
+# Heavy modules (Drive client, RAG pipeline, web fetching) are imported lazily
+# inside the functions that use them, so login and config-error pages render
+# without loading the LLM and database stack
+from config import Config
+from auth_service import AuthService
 
-try:
-    print("DEBUG: Importing config...", file=sys.stderr)
-    from config import Config
-    print("DEBUG: Config imported successfully", file=sys.stderr)
-    
-    print("DEBUG: Importing drive_service...", file=sys.stderr)
-    from drive_service import GoogleDriveService
-    print("DEBUG: drive_service imported successfully", file=sys.stderr)
-    
-    print("DEBUG: Importing rag_pipeline_postgres...", file=sys.stderr)
-    from rag_pipeline_postgres import RAGPipelinePostgres
-    print("DEBUG: rag_pipeline_postgres imported successfully", file=sys.stderr)
-    
-    print("DEBUG: Importing web_content_service...", file=sys.stderr)
-    from web_content_service import WebContentService
-    print("DEBUG: web_content_service imported successfully", file=sys.stderr)
-    
-    print("DEBUG: Importing auth_service...", file=sys.stderr)
-    from auth_service import AuthService
-    print("DEBUG: auth_service imported successfully", file=sys.stderr)
-    
-except Exception as e:
-    print(f"DEBUG: Import error: {str(e)}", file=sys.stderr)
-    import traceback
-    traceback.print_exc(file=sys.stderr)
-    raise
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+logger = logging.getLogger(__name__)
+
+# Maximum chat messages kept in session state (oldest are dropped first)
+MAX_CHAT_MESSAGES = 200
+
+# Number of recent messages rendered on each rerun
+CHAT_HISTORY_WINDOW = 50
 
 # Page configuration
-print("DEBUG: Setting page config...", file=sys.stderr)
 st.set_page_config(
     page_title="Ganesh's RAG Chatbot for Google Drive",
     page_icon="🤖",
     layout="centered",
     initial_sidebar_state="collapsed"
 )
-print("DEBUG: Page config set", file=sys.stderr)
 
 # Initialize services with error handling
-@st.cache_resource
+# Note: these stay on st.cache_resource rather than functools.lru_cache.
+# Streamlit re-executes this script on every rerun, so a module-level
+# lru_cache here would be rebuilt (and empty) each time; cache_resource is
+# the process-wide singleton, and hashing the short string args is negligible.
+@st.cache_resource(show_spinner=False)
 def get_config():
-    print("DEBUG: get_config() called", file=sys.stderr)
+    logger.debug("get_config() called")
     try:
         config = Config()
-        print(f"DEBUG: Config created, is_configured={config.is_configured}", file=sys.stderr)
+        logger.debug("Config created, is_configured=%s", config.is_configured)
         return config
     except Exception as e:
-        print(f"DEBUG: Error in get_config: {str(e)}", file=sys.stderr)
+        logger.error("Error in get_config: %s", e)
         import traceback
         traceback.print_exc(file=sys.stderr)
         raise
 
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_drive_service(folder_id):
-    print(f"DEBUG: get_drive_service() called with folder_id={folder_id}", file=sys.stderr)
+    logger.debug("get_drive_service() called with folder_id=%s", folder_id)
+    from drive_service import GoogleDriveService
     try:
         service = GoogleDriveService(folder_id)
-        print("DEBUG: GoogleDriveService created successfully", file=sys.stderr)
+        logger.debug("GoogleDriveService created successfully")
         return service
     except Exception as e:
-        print(f"DEBUG: Error in get_drive_service: {str(e)}", file=sys.stderr)
+        logger.error("Error in get_drive_service: %s", e)
         import traceback
         traceback.print_exc(file=sys.stderr)
         raise
 
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_rag_pipeline(api_key, use_extended_knowledge=True):
-    print(f"DEBUG: get_rag_pipeline() called (using PostgreSQL + pgvector)", file=sys.stderr)
+    logger.debug("get_rag_pipeline() called (using PostgreSQL + pgvector)")
+    from rag_pipeline_postgres import RAGPipelinePostgres
     try:
         pipeline = RAGPipelinePostgres(api_key, use_extended_knowledge=use_extended_knowledge)
-        print("DEBUG: RAGPipelinePostgres created successfully (query-only mode)", file=sys.stderr)
+        logger.debug("RAGPipelinePostgres created successfully (query-only mode)")
         return pipeline
     except Exception as e:
-        print(f"DEBUG: Error in get_rag_pipeline: {str(e)}", file=sys.stderr)
+        logger.error("Error in get_rag_pipeline: %s", e)
         import traceback
         traceback.print_exc(file=sys.stderr)
         raise
 
-def check_database_status(rag_pipeline):
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_detect_urls(prompt: str) -> List[str]:
+    """Detect URLs in a prompt (pure function of the text, so safe to memoize)"""
+    from web_content_service import WebContentService
+    return WebContentService.detect_urls(prompt)
+
+def fetch_urls(urls: List[str]) -> List[Dict[str, str]]:
+    """Fetch web content for URLs
+    
+    Not wrapped in st.cache_data: WebContentService caches each URL itself,
+    keeping successful pages for 15 minutes and failures only briefly, and
+    an app-level cache would pin failed or partial results for its whole TTL.
+    """
+    from web_content_service import WebContentService
+    return WebContentService.fetch_all_urls(urls)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def check_database_status(_rag_pipeline):
     """Check if database has embeddings (PostgreSQL mode - no document loading)
     
-    Note: This is NOT cached so it always reflects current database state.
-    Database stat queries are fast (~1ms), so no caching needed.
+    Note: Cached for 5 seconds so rapid reruns don't each pay a database round
+    trip, while still picking up a freshly populated database almost at once.
+    The pipeline argument is underscored so Streamlit doesn't try to hash it.
     """
-    print(f"DEBUG: check_database_status() called", file=sys.stderr)
+    logger.debug("check_database_status() called")
     try:
         # Get database statistics (fast COUNT query)
-        stats = rag_pipeline.embedding_store.get_stats()
+        stats = _rag_pipeline.embedding_store.get_stats()
         total_chunks = stats.get('total_chunks', 0)
         total_docs = stats.get('total_documents', 0)
         
-        print(f"📊 Database stats: {total_docs} documents, {total_chunks} chunks", file=sys.stderr)
+        logger.debug("Database stats: %s documents, %s chunks", total_docs, total_chunks)
         
         if total_chunks == 0:
-            print("⚠️ Database is empty. Run the embedding pipeline to populate it.", file=sys.stderr)
+            logger.warning("Database is empty. Run the embedding pipeline to populate it.")
             return {
                 'status': 'empty',
                 'total_docs': 0,
                 'total_chunks': 0
             }
         
-        print(f"✅ Database ready with {total_docs} documents and {total_chunks} chunks", file=sys.stderr)
+        logger.debug("Database ready with %s documents and %s chunks", total_docs, total_chunks)
         return {
             'status': 'ready',
             'total_docs': total_docs,
@@ -117,7 +126,7 @@ def check_database_status(rag_pipeline):
         
     except Exception as e:
         error_msg = f"Error checking database: {str(e)}"
-        print(f"❌ {error_msg}", file=sys.stderr)
+        logger.error(error_msg)
         import traceback
         traceback.print_exc(file=sys.stderr)
         return {
@@ -125,8 +134,34 @@ def check_database_status(rag_pipeline):
             'error': error_msg
         }
 
-# Services will be initialized lazily in the main app flow
-print("DEBUG: Module initialization complete", file=sys.stderr)
+def append_message(role: str, content: str):
+    """Append a chat message, keeping only the most recent MAX_CHAT_MESSAGES
+    
+    Every rerun re-renders the full history, so an unbounded list makes each
+    interaction slower and grows session memory for long conversations.
+    """
+    messages = st.session_state.messages
+    messages.append({"role": role, "content": content})
+    if len(messages) > MAX_CHAT_MESSAGES:
+        del messages[:-MAX_CHAT_MESSAGES]
+
+def coalesce_stream(chunks: Iterator[str], interval: float = 0.05) -> Iterator[str]:
+    """Merge streamed text chunks into ~interval-second batches
+    
+    Each yield becomes a websocket delta in st.write_stream, so batching small
+    Gemini chunks keeps the frontend from re-rendering on every token.
+    """
+    buffer = []
+    last_flush = time.monotonic()
+    for chunk in chunks:
+        buffer.append(chunk)
+        now = time.monotonic()
+        if now - last_flush >= interval:
+            yield "".join(buffer)
+            buffer = []
+            last_flush = now
+    if buffer:
+        yield "".join(buffer)
 
 def initialize_session(rag_pipeline):
     """Initialize session by checking database status (PostgreSQL mode)"""
@@ -157,7 +192,8 @@ def initialize_session(rag_pipeline):
         
         # Add refresh button to check if pipeline has populated the database
         if st.button("🔄 Refresh Database Status"):
-            # Clear all session state to force fresh check
+            # Clear all session state and the cached status to force fresh check
+            check_database_status.clear()
             st.session_state.initialized = False
             if 'database_empty' in st.session_state:
                 del st.session_state.database_empty
@@ -172,9 +208,63 @@ def initialize_session(rag_pipeline):
         st.success(f"✅ Database ready with {db_status['total_docs']} documents ({db_status['total_chunks']} chunks)")
         return True
 
+@st.fragment
+def chat_ui(rag_pipeline):
+    """Chat history and input, rerun as a fragment on each submission
+    
+    Only this block reruns when the user sends a message; the auth check,
+    config check and page chrome in main() are not re-executed.
+    """
+    # Display chat messages (only the most recent window unless expanded)
+    messages = st.session_state.messages
+    hidden_count = len(messages) - CHAT_HISTORY_WINDOW
+    if hidden_count > 0:
+        if not st.toggle(f"Show {hidden_count} earlier message(s)", key="show_full_history"):
+            messages = messages[-CHAT_HISTORY_WINDOW:]
+    
+    # One container per run of same-role messages (e.g. consecutive errors)
+    for role, group in groupby(messages, key=lambda message: message["role"]):
+        with st.chat_message(role):
+            for message in group:
+                st.markdown(message["content"])
+    
+    # Chat input
+    if prompt := st.chat_input("Ask a question about your documents..."):
+        # Add user message
+        append_message("user", prompt)
+        with st.chat_message("user"):
+            st.markdown(prompt)
+        
+        # Generate response
+        with st.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                try:
+                    # Detect URLs in the query
+                    urls = cached_detect_urls(prompt)
+                    web_content = None
+                    
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        # Fetch web content in the background while the pipeline
+                        # runs retrieval; it is awaited just before prompting
+                        if urls:
+                            st.caption(f"🔗 Fetching content from {len(urls)} web link(s)...")
+                            web_content = executor.submit(fetch_urls, urls)
+                        
+                        # Stream response with web content
+                        response = st.write_stream(coalesce_stream(
+                            rag_pipeline.generate_response_stream(prompt, external_web_content=web_content)
+                        ))
+                    append_message("assistant", response)
+                    
+                    if web_content and web_content.result():
+                        st.info(f"🔗 Retrieved content from {len(web_content.result())} web source(s)")
+                except Exception as e:
+                    error_msg = f"❌ Error generating response: {str(e)}"
+                    st.error(error_msg)
+                    append_message("assistant", error_msg)
+
 def main():
     """Main application flow"""
-    print("DEBUG: main() function called", file=sys.stderr)
     
     # Initialize session state
     if 'messages' not in st.session_state:
@@ -185,9 +275,8 @@ def main():
         st.session_state.user_info = None
     
     # Get configuration
-    print("DEBUG: Getting config...", file=sys.stderr)
     config = get_config()
-    print(f"DEBUG: Config loaded, is_configured={config.is_configured}", file=sys.stderr)
+    logger.debug("Config loaded, is_configured=%s", config.is_configured)
     
     # Initialize authentication service
     auth_service = AuthService()
@@ -228,58 +317,22 @@ def main():
             st.code("GOOGLE_DRIVE_FOLDER_ID")
         st.stop()
     
-    # Initialize RAG pipeline (lazy, cached) - Drive service not needed in PostgreSQL mode
-    print("DEBUG: Initializing RAG pipeline...", file=sys.stderr)
-    rag_pipeline = get_rag_pipeline(config.gemini_api_key, config.use_extended_knowledge)
-    print("DEBUG: RAG pipeline initialized successfully", file=sys.stderr)
-    
-    # Auto-initialize on first run (just checks database status)
+    # Auto-initialize on first run (builds the cached pipeline, checks database status)
+    # Drive service not needed in PostgreSQL mode
     if not st.session_state.initialized:
         with st.spinner("Initializing chatbot..."):
+            rag_pipeline = get_rag_pipeline(config.gemini_api_key, config.use_extended_knowledge)
             if not initialize_session(rag_pipeline):
                 st.stop()
+    else:
+        rag_pipeline = get_rag_pipeline(config.gemini_api_key, config.use_extended_knowledge)
     
-    # Display chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-    
-    # Chat input
-    if prompt := st.chat_input("Ask a question about your documents..."):
-        # Add user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        # Generate response
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    # Detect URLs in the query
-                    urls = WebContentService.detect_urls(prompt)
-                    web_content = None
-                    
-                    # Fetch web content if URLs found
-                    if urls:
-                        with st.spinner(f"Fetching content from {len(urls)} web link(s)..."):
-                            web_content = WebContentService.fetch_all_urls(urls)
-                            if web_content:
-                                st.info(f"🔗 Retrieved content from {len(web_content)} web source(s)")
-                    
-                    # Generate response with web content
-                    response = rag_pipeline.generate_response(prompt, external_web_content=web_content)
-                    st.markdown(response)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
-                except Exception as e:
-                    error_msg = f"❌ Error generating response: {str(e)}"
-                    st.error(error_msg)
-                    st.session_state.messages.append({"role": "assistant", "content": error_msg})
+    # Chat history and input rerun in isolation from the rest of the page
+    chat_ui(rag_pipeline)
     
     # Footer
     st.divider()
     st.caption("🤖 RAG Chatbot powered by Google Gemini AI | Built on Replit")
 
 # Run main application
-print("DEBUG: Calling main()...", file=sys.stderr)
 main()
-print("DEBUG: app.py loaded successfully", file=sys.stderr)
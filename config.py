@@ -1,6 +1,15 @@
 import os
+from functools import lru_cache
 from typing import Optional
 
+
+@lru_cache(maxsize=None)
+def get_env(var_name: str) -> Optional[str]:
+    """Read an environment variable once per process (stripped, None if unset/empty)"""
+    value = os.getenv(var_name)
+    return value.strip() if value else None
+
+
 class Config:
     """Configuration management for the RAG chatbot"""
     
@@ -18,8 +27,10 @@ class Config:
     
     def _get_env_var(self, var_name: str, default: Optional[str] = None) -> Optional[str]:
         """Get environment variable with optional default"""
-        value = os.getenv(var_name, default)
-        return value.strip() if value else None
+        value = get_env(var_name)
+        if value is None and default is not None:
+            value = default.strip() or None
+        return value
     
     def _validate_config(self):
         """Validate that required configuration is present"""
@@ -3,20 +3,98 @@ import json
 import tempfile
 import time
 import socket
-from typing import List, Dict, Optional
+import threading
+import queue
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Optional, BinaryIO, Callable, Iterator
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseDownload
 from google.auth.exceptions import DefaultCredentialsError
 from google.oauth2 import service_account
 from googleapiclient.errors import HttpError
+from config import get_env
 from text_extractors import TextExtractor
 
 
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4)
+def _service_account_credentials(credentials_json: str) -> service_account.Credentials:
+    """
+    Build read-only Drive credentials for a service account key, once per key
+
+    Every GoogleDriveService built from the same key shares one credentials
+    object, so the OAuth access token is fetched once and then reused until
+    it expires instead of per instance.
+    """
+    # Parse the JSON credentials
+    try:
+        credentials_dict = json.loads(credentials_json)
+    except json.JSONDecodeError:
+        raise ValueError(
+            "Invalid JSON format in GOOGLE_SERVICE_ACCOUNT_KEY")
+
+    return service_account.Credentials.from_service_account_info(
+        credentials_dict,
+        scopes=['https://www.googleapis.com/auth/drive.readonly'])
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls at most `rate` per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self):
+        """Block until the caller may issue its next request"""
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
 class GoogleDriveService:
     """Service for interacting with Google Drive API"""
 
-    def __init__(self, folder_id: Optional[str] = None):
+    MAX_DOWNLOAD_WORKERS = 8
+    MAX_REQUESTS_PER_SECOND = 10  # Stay under Drive's per-user request quota
+    SPOOL_MAX_SIZE = 8 << 20  # Keep downloads in memory up to 8 MiB, then spill to disk
+    DOWNLOAD_CHUNK_SIZE = 1 << 20
+    # Half the cores at most, leaving the rest to the caller (embed_pipeline encodes with torch meanwhile)
+    MAX_EXTRACT_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+    EXTRACTED_TYPES = frozenset({'application/pdf', 'image/jpeg', 'image/jpg'})  # Types parsed in the process pool
+    LOAD_AHEAD_FACTOR = 2  # Files in flight per download worker in iter_documents
+
+    def __init__(self, folder_id: Optional[str] = None, cache_path: Optional[str] = None):
+        """
+        Args:
+            folder_id: Drive folder to load documents from
+            cache_path: Optional JSON file persisting extracted text across runs
+                (defaults to DRIVE_CONTENT_CACHE_PATH env var; in-memory only if unset)
+        """
         self.folder_id = folder_id
         self.service = None
+        self.credentials = None
+        self.http = None
+        # Idle authorized clients, reused across downloads and load_documents calls
+        self._http_pool: queue.SimpleQueue = queue.SimpleQueue()
+        self._rate_limiter = RateLimiter(self.MAX_REQUESTS_PER_SECOND)
+        self._extract_pool: Optional[ProcessPoolExecutor] = None
+        self.cache_path = cache_path or get_env("DRIVE_CONTENT_CACHE_PATH")
+        # file_id -> {'modified_time': ..., 'content': ...}
+        self._content_cache: Dict[str, Dict[str, str]] = self._load_content_cache()
         self._initialize_service()
 
     def _initialize_service(self):
@@ -26,159 +104,316 @@ class GoogleDriveService:
             socket.setdefaulttimeout(60.0)
             
             # Get service account credentials from environment variable
-            service_account_key = os.getenv("GOOGLE_SERVICE_ACCOUNT_KEY")
+            credentials_json = get_env("GOOGLE_SERVICE_ACCOUNT_KEY")
 
-            if not service_account_key:
+            if not credentials_json:
                 raise ValueError(
                     "GOOGLE_SERVICE_ACCOUNT_KEY environment variable not set")
 
-            # Parse the JSON credentials
+            credentials = _service_account_credentials(credentials_json)
+
+            # Build the service on one authorized HTTP client so every call
+            # reuses its keep-alive connection instead of a fresh TLS handshake
+            self.credentials = credentials
+            self.http = self._create_authorized_http()
+            self.service = build('drive', 'v3', http=self.http, cache_discovery=False,
+                                 static_discovery=True)
+
+            logger.info("✅ Google Drive service initialized successfully")
+
+        except Exception as e:
+            logger.error("❌ Error initializing Google Drive service: %s", e)
+            raise
+
+    def _create_authorized_http(self) -> AuthorizedHttp:
+        """Create an authorized httplib2 client with persistent connections"""
+        return AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=60))
+
+    def _load_content_cache(self) -> Dict[str, Dict[str, str]]:
+        """Load the persisted extracted-text cache, if configured"""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            logger.info("📋 Loaded %s cached Drive files from %s", len(cache), self.cache_path)
+            return cache
+        except Exception as e:
+            logger.warning("⚠️ Could not read Drive content cache, starting fresh: %s", e)
+            return {}
+
+    def _save_content_cache(self):
+        """Persist the extracted-text cache atomically (temp file + rename)"""
+        if not self.cache_path:
+            return
+
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+            with tempfile.NamedTemporaryFile(
+                    'w', encoding='utf-8', dir=cache_dir, delete=False) as f:
+                json.dump(self._content_cache, f)
+                temp_path = f.name
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            logger.warning("⚠️ Could not write Drive content cache: %s", e)
+
+    def _list_files(self) -> List[Dict]:
+        """List supported files in the folder, following all result pages
+
+        Filtering happens server-side in the query and only the fields the
+        loader consumes are requested, so no irrelevant metadata is transferred.
+        """
+        # Search for supported file types (TXT, PDF, JPG/JPEG)
+        supported_types = [
+            "mimeType='text/plain'", "mimeType='application/pdf'",
+            "mimeType='image/jpeg'", "mimeType='image/jpg'"
+        ]
+        type_query = " or ".join(supported_types)
+        query = f"'{self.folder_id}' in parents and ({type_query}) and trashed=false"
+
+        files = []
+        page_token = None
+
+        while True:
+            results = self.service.files().list(
+                q=query,
+                fields="nextPageToken, files(id, name, size, modifiedTime, mimeType)",
+                pageSize=1000,
+                pageToken=page_token).execute()
+
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+
+    def _acquire_http(self) -> AuthorizedHttp:
+        """Check out an idle authorized HTTP client, creating one if none is free
+
+        httplib2 connections are not thread-safe, so each in-flight download
+        gets its own client. Clients go back to the pool afterwards, keeping
+        their keep-alive connections warm for later downloads and later
+        load_documents calls rather than dying with the worker threads.
+        """
+        try:
+            return self._http_pool.get_nowait()
+        except queue.Empty:
+            return self._create_authorized_http()
+
+    def _release_http(self, http: AuthorizedHttp):
+        """Return a healthy client to the pool"""
+        self._http_pool.put(http)
+
+    def _download_file(self, file_id: str, file_name: str) -> Optional[BinaryIO]:
+        """
+        Download file content with retry logic for SSL/network errors
+
+        The file is streamed into a spooled temp file that stays in memory up
+        to SPOOL_MAX_SIZE and spills to disk beyond that, so large files never
+        exist as one big bytes object. The caller is responsible for closing it.
+        """
+        file_content = None
+        max_retries = 3
+        retry_delay = 1
+
+        for attempt in range(max_retries):
+            buffer = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE)
+            http = self._acquire_http()
             try:
-                credentials_dict = json.loads(service_account_key)
-            except json.JSONDecodeError:
-                raise ValueError(
-                    "Invalid JSON format in GOOGLE_SERVICE_ACCOUNT_KEY")
+                self._rate_limiter.acquire()
+                request = self.service.files().get_media(fileId=file_id)
+                request.http = http
+                downloader = MediaIoBaseDownload(buffer, request, chunksize=self.DOWNLOAD_CHUNK_SIZE)
+                done = False
+                while not done:
+                    _, done = downloader.next_chunk()
+                buffer.seek(0)
+                file_content = buffer
+                self._release_http(http)
+                break
+            except Exception as download_error:
+                # Drop the client rather than pooling a possibly broken connection
+                buffer.close()
+                if attempt < max_retries - 1:
+                    logger.warning("⚠️ Download attempt %s failed for %s: %s; retrying in %ss",
+                                   attempt + 1, file_name, download_error, retry_delay)
+                    time.sleep(retry_delay)
+                    retry_delay *= 2  # Exponential backoff
+                else:
+                    raise  # Re-raise on final attempt
+
+        return file_content
+
+    @staticmethod
+    def _build_document(file_info: Dict, content: str) -> Dict[str, str]:
+        """Build the document dict returned by load_documents"""
+        return {
+            'id': file_info['id'],
+            'name': file_info['name'],
+            'content': content,
+            'size': file_info.get('size', 0),
+            'modified_time': file_info.get('modifiedTime', ''),
+            'file_type': file_info.get('mimeType', 'unknown')
+        }
+
+    def _needs_extraction(self, file_info: Dict) -> bool:
+        """True if loading this file would run a PDF or OCR extractor"""
+        if file_info.get('mimeType') not in self.EXTRACTED_TYPES:
+            return False
+        cached = self._content_cache.get(file_info['id'])
+        modified_time = file_info.get('modifiedTime', '')
+        return not (cached and modified_time and cached.get('modified_time') == modified_time)
+
+    def _extract(self, extractor: Callable[[bytes], Optional[str]],
+                 file_content: BinaryIO) -> Optional[str]:
+        """
+        Run a CPU-bound extractor (PDF parsing, OCR) in the extraction process
+        pool when load_documents has one active, otherwise in this thread.
+        The calling download thread just waits on the result, so downloads
+        keep overlapping while extraction uses every core.
+        """
+        if self._extract_pool is None:
+            return extractor(file_content)
+        return self._extract_pool.submit(extractor, file_content.read()).result()
+
+    def _load_file(self, file_info: Dict) -> Optional[Dict[str, str]]:
+        """Download and extract a single file, returning None on any failure"""
+        try:
+            file_id = file_info['id']
+            file_name = file_info['name']
+            file_type = file_info.get('mimeType', 'unknown')
+            modified_time = file_info.get('modifiedTime', '')
+
+            # Unchanged since the last load - reuse extracted text, no download
+            cached = self._content_cache.get(file_id)
+            if cached and modified_time and cached.get('modified_time') == modified_time:
+                logger.info("♻️ Unchanged: %s, using cached content", file_name)
+                return self._build_document(file_info, cached['content'])
+
+            logger.info("📥 Loading: %s (%s)", file_name, file_type)
+
+            file_content = self._download_file(file_id, file_name)
+
+            if file_content is None:
+                logger.warning("⚠️ Failed to download %s, skipping...", file_name)
+                return None
+
+            # Extract text based on file type
+            content = None
+
+            with file_content:
+                if file_type == 'text/plain':
+                    # Plain text file
+                    content = TextExtractor.extract_from_text(file_content)
+
+                elif file_type == 'application/pdf':
+                    # PDF file
+                    content = self._extract(TextExtractor.extract_from_pdf, file_content)
+
+                elif file_type in ['image/jpeg', 'image/jpg']:
+                    # Image file (OCR)
+                    content = self._extract(TextExtractor.extract_from_image, file_content)
+
+                else:
+                    logger.warning("⚠️ Unsupported file type: %s, skipping...", file_type)
+                    return None
+
+            # Check if extraction was successful
+            if not content or not content.strip():
+                logger.warning("⚠️ No text extracted from %s, skipping...", file_name)
+                return None
 
-            # Create credentials from service account info
-            credentials = service_account.Credentials.from_service_account_info(
-                credentials_dict,
-                scopes=['https://www.googleapis.com/auth/drive.readonly'])
+            logger.info("✅ Loaded: %s (%s characters)", file_name, len(content))
 
-            # Build the service
-            self.service = build('drive', 'v3', credentials=credentials)
+            if modified_time:
+                self._content_cache[file_id] = {
+                    'modified_time': modified_time,
+                    'content': content
+                }
 
-            print("✅ Google Drive service initialized successfully")
+            return self._build_document(file_info, content)
 
         except Exception as e:
-            print(f"❌ Error initializing Google Drive service: {str(e)}")
-            raise
+            logger.error("❌ Error loading file %s: %s", file_info.get('name', 'unknown'), e)
+            return None
 
     def load_documents(self) -> List[Dict[str, str]]:
         """Load documents from the specified Google Drive folder (supports TXT, PDF, JPG)"""
+        return list(self.iter_documents())
+
+    def iter_documents(self) -> Iterator[Dict[str, str]]:
+        """
+        Yield documents from the folder as each one finishes loading
+
+        Downloads keep running in the background while the caller works on
+        the documents already yielded, but at most LOAD_AHEAD_FACTOR x workers
+        files are in flight or waiting at once, which bounds memory.
+        Documents come out in completion order, not listing order.
+        """
         if not self.service:
             raise RuntimeError("Google Drive service not initialized")
 
         if not self.folder_id:
             raise ValueError("Google Drive folder ID not specified")
 
-        documents = []
-
         try:
-            # Search for supported file types (TXT, PDF, JPG/JPEG)
-            supported_types = [
-                "mimeType='text/plain'", "mimeType='application/pdf'",
-                "mimeType='image/jpeg'", "mimeType='image/jpg'"
-            ]
-            type_query = " or ".join(supported_types)
-            query = f"'{self.folder_id}' in parents and ({type_query}) and trashed=false"
-
-            results = self.service.files().list(
-                q=query,
-                fields="files(id, name, size, modifiedTime, mimeType)",
-                pageSize=100).execute()
-
-            files = results.get('files', [])
+            files = self._list_files()
 
             if not files:
-                print(
-                    f"⚠️ No supported files found in folder {self.folder_id}")
-                print(f"   Supported types: TXT, PDF, JPG/JPEG")
-                return documents
-
-            print(f"📄 Found {len(files)} files in Google Drive folder")
-
-            # Download and process each file
-            for file_info in files:
+                logger.warning("⚠️ No supported files found in folder %s", self.folder_id)
+                logger.info("   Supported types: TXT, PDF, JPG/JPEG")
+                return
+
+            logger.info("📄 Found %s files in Google Drive folder", len(files))
+
+            # Download and process files concurrently; downloads are I/O-bound
+            # so wall time approaches (files / workers) x per-file latency.
+            # PDF/OCR extraction is CPU-bound and goes to a process pool, which
+            # is only started when some file will actually be extracted. Its
+            # workers start lazily from the download threads, so they are
+            # spawned rather than forked: forking while other threads hold
+            # httplib2/SSL/logging locks can deadlock the child.
+            max_workers = min(len(files), self.MAX_DOWNLOAD_WORKERS)
+            remaining = iter(files)
+            loaded_count = 0
+            with ExitStack() as stack:
+                if any(self._needs_extraction(file_info) for file_info in files):
+                    self._extract_pool = stack.enter_context(ProcessPoolExecutor(
+                        max_workers=min(len(files), self.MAX_EXTRACT_WORKERS),
+                        mp_context=multiprocessing.get_context('spawn')))
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers))
                 try:
-                    file_id = file_info['id']
-                    file_name = file_info['name']
-                    file_type = file_info.get('mimeType', 'unknown')
-
-                    print(f"📥 Loading: {file_name} ({file_type})")
-
-                    # Download file content with retry logic for SSL/network errors
-                    file_content = None
-                    max_retries = 3
-                    retry_delay = 1
-                    
-                    for attempt in range(max_retries):
-                        try:
-                            file_content = self.service.files().get_media(
-                                fileId=file_id).execute()
-                            break
-                        except Exception as download_error:
-                            if attempt < max_retries - 1:
-                                print(f"⚠️ Download attempt {attempt + 1} failed for {file_name}: {str(download_error)}")
-                                print(f"   Retrying in {retry_delay}s...")
-                                time.sleep(retry_delay)
-                                retry_delay *= 2  # Exponential backoff
-                            else:
-                                raise  # Re-raise on final attempt
-                    
-                    if file_content is None:
-                        print(f"⚠️ Failed to download {file_name} after {max_retries} attempts, skipping...")
-                        continue
-
-                    # Extract text based on file type
-                    content = None
-
-                    if file_type == 'text/plain':
-                        # Plain text file
-                        content = TextExtractor.extract_from_text(file_content)
-
-                    elif file_type == 'application/pdf':
-                        # PDF file
-                        content = TextExtractor.extract_from_pdf(file_content)
-
-                    elif file_type in ['image/jpeg', 'image/jpg']:
-                        # Image file (OCR)
-                        content = TextExtractor.extract_from_image(
-                            file_content)
-
-                    else:
-                        print(
-                            f"⚠️ Unsupported file type: {file_type}, skipping..."
-                        )
-                        continue
-
-                    # Check if extraction was successful
-                    if not content or not content.strip():
-                        print(
-                            f"⚠️ No text extracted from {file_name}, skipping..."
+                    pending = {
+                        executor.submit(self._load_file, file_info)
+                        for file_info in islice(remaining, max_workers * self.LOAD_AHEAD_FACTOR)
+                    }
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        # Refill the window before handing results back so
+                        # downloads continue while the caller is busy
+                        pending.update(
+                            executor.submit(self._load_file, file_info)
+                            for file_info in islice(remaining, len(done))
                         )
-                        continue
-
-                    # Add document to collection
-                    documents.append({
-                        'id':
-                        file_id,
-                        'name':
-                        file_name,
-                        'content':
-                        content,
-                        'size':
-                        file_info.get('size', 0),
-                        'modified_time':
-                        file_info.get('modifiedTime', ''),
-                        'file_type':
-                        file_type
-                    })
-
-                    print(f"✅ Loaded: {file_name} ({len(content)} characters)")
-
-                except Exception as e:
-                    print(
-                        f"❌ Error loading file {file_info.get('name', 'unknown')}: {str(e)}"
-                    )
-                    continue
-
-            print(
-                f"✅ Successfully loaded {len(documents)} documents from Google Drive"
-            )
-            return documents
+                        for future in done:
+                            doc = future.result()
+                            if doc:
+                                loaded_count += 1
+                                yield doc
+                finally:
+                    self._extract_pool = None
+
+            # Drop cache entries for files no longer in the folder, then persist
+            current_ids = {file_info['id'] for file_info in files}
+            for file_id in list(self._content_cache):
+                if file_id not in current_ids:
+                    del self._content_cache[file_id]
+            self._save_content_cache()
+
+            logger.info("✅ Successfully loaded %s documents from Google Drive", loaded_count)
 
         except Exception as e:
-            print(f"❌ Error accessing Google Drive folder: {str(e)}")
+            logger.error("❌ Error accessing Google Drive folder: %s", e)
             raise
 
     def test_connection(self) -> bool:
@@ -193,18 +428,16 @@ class GoogleDriveService:
                     fileId=self.folder_id,
                     fields="id, name, mimeType").execute()
 
-                print(
-                    f"✅ Connected to folder: {folder_info.get('name', 'Unknown')}"
-                )
+                logger.info("✅ Connected to folder: %s", folder_info.get('name', 'Unknown'))
                 return True
             else:
                 # Just test API access
-                self.service.files().list(pageSize=1).execute()
-                print("✅ Google Drive API connection successful")
+                self.service.files().list(pageSize=1, fields="files(id)").execute()
+                logger.info("✅ Google Drive API connection successful")
                 return True
 
         except Exception as e:
-            print(f"❌ Google Drive connection test failed: {str(e)}")
+            logger.error("❌ Google Drive connection test failed: %s", e)
             return False
 
     def get_folder_info(self) -> Optional[Dict]:
@@ -221,5 +454,5 @@ class GoogleDriveService:
             return folder_info
 
         except Exception as e:
-            print(f"❌ Error getting folder info: {str(e)}")
+            logger.error("❌ Error getting folder info: %s", e)
             return None
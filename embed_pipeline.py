@@ -16,48 +16,130 @@ Environment Variables Required:
 import os
 import sys
 import argparse
-from typing import List, Dict
+import logging
+from typing import List, Dict, Optional, Tuple
+from config import get_env
 from drive_service import GoogleDriveService
-from postgres_embedding_store import PostgresEmbeddingStore, compute_text_hash, compute_document_hash
+from postgres_embedding_store import (
+    PostgresEmbeddingStore, EMBEDDING_DIMENSION, compute_text_hash, compute_document_hash,
+    compute_legacy_text_hash, compute_legacy_document_hash, is_legacy_hash
+)
+from web_content_service import WebContentService
 import re
+import numpy as np
 
-try:
-    from sentence_transformers import SentenceTransformer
-    EMBEDDING_MODEL_AVAILABLE = True
-except ImportError:
-    EMBEDDING_MODEL_AVAILABLE = False
-    print("❌ sentence-transformers not installed. Run: pip install sentence-transformers")
-    sys.exit(1)
+logger = logging.getLogger(__name__)
+
+# drive_service's spawned extraction workers re-import this script as
+# __mp_main__; they only run text extractors, so they skip loading torch
+if __name__ != "__mp_main__":
+    try:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        from tqdm import tqdm
+        EMBEDDING_MODEL_AVAILABLE = True
+    except ImportError:
+        EMBEDDING_MODEL_AVAILABLE = False
+        logger.error("❌ sentence-transformers not installed. Run: pip install sentence-transformers")
+        sys.exit(1)
+
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+
+# Pattern used by _chunk_text, compiled once at import
+WHITESPACE_PATTERN = re.compile(r'\s+')
 
 
 class EmbeddingPipeline:
     """Standalone pipeline for processing documents and generating embeddings"""
     
+    FLUSH_CHUNKS = 1024  # Pending chunks that trigger an embed-and-store pass
+    
     def __init__(self):
         """Initialize pipeline components"""
-        print("="*60)
-        print("🚀 RAG Chatbot Embedding Pipeline")
-        print("="*60)
+        logger.info("=" * 60)
+        logger.info("🚀 RAG Chatbot Embedding Pipeline")
+        logger.info("=" * 60)
         
         # Validate environment
         self._validate_environment()
         
         # Initialize components
-        print("\n📦 Initializing components...")
+        logger.info("📦 Initializing components...")
         self.drive_service = GoogleDriveService(
-            folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+            folder_id=get_env("GOOGLE_DRIVE_FOLDER_ID")
         )
         
         self.embedding_store = PostgresEmbeddingStore()
         
-        print("🔄 Loading sentence-transformers model...")
-        self.embedding_model = SentenceTransformer(
-            'sentence-transformers/all-MiniLM-L6-v2',
-            device='cpu'
-        )
-        print("✅ Embedding model loaded (768-dim, local)")
+        self.device = self._select_device()
+        # Larger batches keep a GPU busy; on CPU 64 already saturates the BLAS
+        self.encode_batch_size = 128 if self.device == 'cuda' else 64
+        
+        # Optional directory for per-document embedding checkpoints
+        self.embed_cache_dir = get_env("EMBED_CACHE_DIR")
+        if self.embed_cache_dir:
+            os.makedirs(self.embed_cache_dir, exist_ok=True)
         
-        print("✅ Pipeline initialization complete\n")
+        logger.info("🔄 Loading sentence-transformers model on %s...", self.device)
+        self.embedding_model = self._load_embedding_model()
+        self.tokenizer = self.embedding_model.tokenizer
+        dimension = self.embedding_model.get_sentence_embedding_dimension()
+        if dimension != EMBEDDING_DIMENSION:
+            raise ValueError(
+                f"{EMBEDDING_MODEL_NAME} produces {dimension}-dim embeddings, "
+                f"but the database stores {EMBEDDING_DIMENSION}-dim vectors")
+        logger.info("✅ Embedding model loaded (%s-dim, local)", dimension)
+        
+        logger.info("✅ Pipeline initialization complete")
+    
+    def _select_device(self) -> str:
+        """
+        Pick the encoding device: CUDA when available, otherwise CPU with
+        PyTorch's intra-op pool sized to the machine (EMBED_THREADS overrides).
+        Container defaults often leave most cores idle.
+        """
+        if torch.cuda.is_available():
+            return 'cuda'
+        
+        num_threads = int(get_env("EMBED_THREADS") or os.cpu_count() or 1)
+        torch.set_num_threads(num_threads)
+        try:
+            # Batches are encoded one after another, so inter-op parallelism only adds overhead
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # Can only be set before any parallel work has started
+        logger.info("🧵 Using %s CPU threads for encoding", num_threads)
+        return 'cpu'
+    
+    def _load_embedding_model(self) -> 'SentenceTransformer':
+        """
+        Load the embedding model, optionally as an int8-quantized ONNX export.
+        
+        Set EMBEDDING_ONNX_FILE to one of the quantized files shipped in the
+        model repo (e.g. onnx/model_qint8_avx2.onnx or
+        onnx/model_qint8_avx512_vnni.onnx) to run encoding through ONNX Runtime
+        int8 kernels, typically 2-4x faster on CPU. Needs
+        `pip install sentence-transformers[onnx]`; falls back to PyTorch FP32.
+        """
+        onnx_file = get_env("EMBEDDING_ONNX_FILE")
+        if onnx_file and self.device == 'cpu':
+            try:
+                model = SentenceTransformer(
+                    EMBEDDING_MODEL_NAME,
+                    device='cpu',
+                    backend='onnx',
+                    model_kwargs={'file_name': onnx_file}
+                )
+                logger.info("⚡ Using ONNX Runtime backend (%s)", onnx_file)
+                return model
+            except Exception as e:
+                logger.warning("⚠️ Could not load ONNX model %s, falling back to PyTorch: %s", onnx_file, e)
+        
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=self.device)
+        if self.device == 'cuda':
+            model.half()  # FP16 roughly doubles GPU throughput for MiniLM
+        return model
     
     def _validate_environment(self):
         """Validate required environment variables"""
@@ -67,171 +149,282 @@ class EmbeddingPipeline:
             "SUPABASE_DATABASE_URL"
         ]
         
-        missing = [var for var in required_vars if not os.getenv(var)]
+        missing = [var for var in required_vars if not get_env(var)]
         if missing:
-            print(f"❌ Missing required environment variables: {', '.join(missing)}")
+            logger.error("❌ Missing required environment variables: %s", ', '.join(missing))
             sys.exit(1)
     
-    def _chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
-        """Split text into overlapping chunks (same logic as rag_pipeline_vector.py)"""
-        text = re.sub(r'\s+', ' ', text.strip())
+    def _chunk_text(self, text: str, chunk_size: int = 200, overlap: int = 32) -> List[str]:
+        """Split text into overlapping windows of model tokens
+        
+        Windows are measured in tokens of the embedding model's own tokenizer,
+        so every chunk fits the model's 256-token limit instead of being
+        silently truncated. Chunk text is sliced from the original string via
+        the tokenizer's character offsets, so casing and punctuation survive.
+        
+        Args:
+            text: Document text
+            chunk_size: Tokens per chunk
+            overlap: Tokens shared by consecutive chunks
+        """
+        text = WHITESPACE_PATTERN.sub(' ', text.strip())
         
-        if len(text) <= chunk_size:
+        offsets = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False
+        )['offset_mapping']
+        num_tokens = len(offsets)
+        
+        if num_tokens <= chunk_size:
             return [text]
         
         chunks = []
         start = 0
         
-        while start < len(text):
-            end = start + chunk_size
-            
-            if end >= len(text):
-                chunks.append(text[start:])
+        while True:
+            end = min(start + chunk_size, num_tokens)
+            chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+            if end >= num_tokens:
                 break
-            
-            chunk_text = text[start:end]
-            
-            # Try to break at sentence boundary
-            last_sentence = max(
-                chunk_text.rfind('. '),
-                chunk_text.rfind('! '),
-                chunk_text.rfind('? ')
-            )
-            
-            if last_sentence > chunk_size * 0.5:
-                end = start + last_sentence + 1
-            else:
-                last_space = chunk_text.rfind(' ')
-                if last_space > chunk_size * 0.7:
-                    end = start + last_space
-            
-            chunks.append(text[start:end].strip())
             start = end - overlap
         
-        return [chunk for chunk in chunks if len(chunk.strip()) > 20]
+        return chunks
     
-    def _generate_embeddings(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
-        """Generate embeddings using local sentence-transformers model"""
+    def _generate_embeddings(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Generate embeddings using local sentence-transformers model
+        
+        Returns a single (len(texts), dim) float32 matrix; rows are passed on as
+        ndarray views rather than converted to Python float lists.
+        """
         if not texts:
-            return []
+            return np.empty((0, 0), dtype=np.float32)
         
-        print(f"  🔄 Generating {len(texts)} embeddings locally...")
-        embeddings = []
+        logger.info("🔄 Generating %d embeddings locally...", len(texts))
+        batches = []
         
-        for i in range(0, len(texts), batch_size):
+        starts = range(0, len(texts), batch_size)
+        for i in tqdm(starts, desc="Embedding batches", disable=not sys.stderr.isatty()):
             batch = texts[i:i + batch_size]
-            batch_num = i // batch_size + 1
-            total_batches = (len(texts) - 1) // batch_size + 1
-            print(f"    Batch {batch_num}/{total_batches}")
-            
-            batch_embeddings = self.embedding_model.encode(
+            batches.append(self.embedding_model.encode(
                 batch,
                 convert_to_numpy=True,
                 show_progress_bar=False,
                 batch_size=batch_size
-            )
-            
-            for embedding in batch_embeddings:
-                embeddings.append(embedding.tolist())
+            ))
         
-        print(f"  ✅ Generated {len(embeddings)} embeddings (768-dim, 0 API calls)")
+        embeddings = np.concatenate(batches, axis=0).astype(np.float32, copy=False)
+        
+        logger.info("✅ Generated %d embeddings (%d-dim, 0 API calls)", len(embeddings), embeddings.shape[1])
         return embeddings
     
     def process_documents(self, force_rebuild: bool = False):
         """
         Main pipeline: load documents, detect changes, generate embeddings, update DB
         
+        Documents are embedded while Drive is still downloading the rest;
+        changed documents are buffered until about FLUSH_CHUNKS chunks are
+        pending, so encode() still runs over large cross-document batches.
+        
         Args:
             force_rebuild: If True, reprocess all documents regardless of changes
         """
-        print("📥 Loading documents from Google Drive...")
-        documents = self.drive_service.load_documents()
-        print(f"✅ Loaded {len(documents)} documents\n")
-        
         # Get existing document hashes from database
         if force_rebuild:
-            print("🔄 Force rebuild mode: processing all documents\n")
+            logger.info("🔄 Force rebuild mode: processing all documents")
             cached_hashes = {}
         else:
             cached_hashes = self.embedding_store.get_all_document_hashes()
-            print(f"📋 Found {len(cached_hashes)} documents in database\n")
+            logger.info("📋 Found %s documents in database", len(cached_hashes))
         
-        # Detect changed documents
-        current_hashes = {
-            doc['id']: compute_document_hash(doc) 
-            for doc in documents
-        }
+        logger.info("📥 Loading documents from Google Drive...")
+        loaded_count = 0
+        changed_count = 0
+        pending = []
+        pending_chunks = 0
         
-        changed_docs = [
-            doc for doc in documents
-            if force_rebuild or cached_hashes.get(doc['id']) != current_hashes[doc['id']]
-        ]
+        # Large loads defer HNSW index maintenance to a single rebuild at the end
+        with self.embedding_store.ingest_context():
+            for doc in self.drive_service.iter_documents():
+                loaded_count += 1
+                
+                # Detect changed documents
+                doc_hash = compute_document_hash(doc)
+                stored_hash = cached_hashes.get(doc['id'])
+                if not force_rebuild and stored_hash is not None and (
+                        stored_hash == doc_hash
+                        or (is_legacy_hash(stored_hash) and stored_hash == compute_legacy_document_hash(doc))):
+                    continue
+                
+                changed_count += 1
+                chunks = self._chunk_text(doc['content'])
+                logger.info("📄 Chunked %s (%d chars) into %d chunks", doc['name'], len(doc['content']), len(chunks))
+                pending.append((doc, doc_hash, chunks, [compute_text_hash(chunk) for chunk in chunks]))
+                pending_chunks += len(chunks)
+                
+                if pending_chunks >= self.FLUSH_CHUNKS:
+                    self._embed_and_store(pending, force_rebuild)
+                    pending = []
+                    pending_chunks = 0
+            
+            if pending:
+                self._embed_and_store(pending, force_rebuild)
         
-        if not changed_docs:
-            print("✅ All documents up to date. No processing needed.")
-            return
+        logger.info("✅ Loaded %s documents", loaded_count)
         
-        print(f"🔄 Processing {len(changed_docs)} changed/new documents:\n")
+        if not changed_count:
+            logger.info("✅ All documents up to date. No processing needed.")
+            return
         
-        for doc in changed_docs:
-            self._process_single_document(doc, current_hashes[doc['id']])
+        logger.info("🔄 Processed %s changed/new documents", changed_count)
         
         # Show final stats
-        print("\n" + "="*60)
+        logger.info("=" * 60)
         stats = self.embedding_store.get_stats()
-        print(f"📊 Pipeline Statistics:")
-        print(f"   Total documents: {stats.get('total_documents', 0)}")
-        print(f"   Total chunks: {stats.get('total_chunks', 0)}")
-        print(f"   Avg chunks/doc: {stats.get('avg_chunks_per_doc', 0):.1f}")
-        print("="*60)
-        print("✅ Pipeline execution complete!\n")
+        logger.info("📊 Pipeline Statistics:")
+        logger.info("   Total documents: %s", stats.get('total_documents', 0))
+        logger.info("   Total chunks: %s", stats.get('total_chunks', 0))
+        logger.info("   Avg chunks/doc: %.1f", stats.get('avg_chunks_per_doc', 0))
+        logger.info("=" * 60)
+        logger.info("✅ Pipeline execution complete!")
     
-    def _process_single_document(self, doc: Dict[str, str], doc_hash: str):
-        """Process a single document: chunk, embed, upsert"""
-        doc_id = doc['id']
-        doc_name = doc['name']
-        content = doc['content']
+    def _embed_and_store(self, batch: List[Tuple[Dict[str, str], str, List[str], List[str]]],
+                         force_rebuild: bool):
+        """
+        Embed and store a batch of changed documents
+        
+        Args:
+            batch: (doc, doc_hash, chunks, chunk_text_hashes) per document
+            force_rebuild: If True, ignore stored embeddings and checkpoints
+        """
+        # Reuse stored embeddings for chunks whose text is already in the
+        # database under any document, so a small edit only re-embeds the
+        # chunks it touched and boilerplate shared across documents is
+        # embedded once
+        if force_rebuild:
+            embeddings_by_hash = {}
+        else:
+            embeddings_by_hash = self.embedding_store.get_chunk_embeddings_by_hash(
+                list({text_hash for _, _, _, hashes in batch for text_hash in hashes})
+            )
+            
+            # Chunks stored before the switch to xxh3 carry the legacy SHA-256
+            # text_hash; look the misses up under that so they are reused too
+            legacy_hashes = {
+                compute_legacy_text_hash(chunk): text_hash
+                for _, _, chunks, hashes in batch
+                for chunk, text_hash in zip(chunks, hashes)
+                if text_hash not in embeddings_by_hash
+            }
+            if legacy_hashes:
+                legacy_embeddings = self.embedding_store.get_chunk_embeddings_by_hash(list(legacy_hashes))
+                for legacy_hash, embedding in legacy_embeddings.items():
+                    embeddings_by_hash[legacy_hashes[legacy_hash]] = embedding
+            
+            # Embeddings checkpointed by an earlier run that failed before storing
+            for doc, doc_hash, _, hashes in batch:
+                checkpoint = self._load_checkpoint(doc['id'], doc_hash, len(hashes))
+                if checkpoint is not None:
+                    embeddings_by_hash.update(zip(hashes, checkpoint))
         
-        print(f"📄 Processing: {doc_name}")
-        print(f"   Document ID: {doc_id}")
-        print(f"   Content length: {len(content)} chars")
+        new_texts = {}
+        for _, _, chunks, hashes in batch:
+            for chunk, text_hash in zip(chunks, hashes):
+                if text_hash not in embeddings_by_hash:
+                    new_texts.setdefault(text_hash, chunk)
         
-        # Step 1: Delete existing chunks for this document
-        self.embedding_store.delete_document_chunks(doc_id)
+        total_chunks = sum(len(chunks) for _, _, chunks, _ in batch)
+        logger.info("♻️ Reusing %d stored embeddings, embedding %d new/changed chunks from %d documents",
+                    total_chunks - len(new_texts), len(new_texts), len(batch))
         
-        # Step 2: Chunk the document
-        chunks = self._chunk_text(content)
-        print(f"   ✅ Created {len(chunks)} chunks")
+        # Embed all new chunks together so encode() runs at full batch width
+        # instead of once per (often small) document
+        if new_texts:
+            embeddings = self._generate_embeddings(list(new_texts.values()), batch_size=self.encode_batch_size)
+            embeddings_by_hash.update(zip(new_texts.keys(), embeddings))
+        
+        # Assemble each document's embeddings, checkpoint them all before
+        # touching the database, then store
+        doc_embeddings = [
+            [embeddings_by_hash[text_hash] for text_hash in hashes]
+            for _, _, _, hashes in batch
+        ]
+        if new_texts:
+            for (doc, doc_hash, _, _), chunk_embeddings in zip(batch, doc_embeddings):
+                self._save_checkpoint(doc['id'], doc_hash, chunk_embeddings)
+        
+        for (doc, doc_hash, chunks, hashes), chunk_embeddings in zip(batch, doc_embeddings):
+            self._store_document(doc, doc_hash, chunks, hashes, chunk_embeddings)
+            self._remove_checkpoint(doc['id'], doc_hash)
+    
+    def _checkpoint_path(self, doc_id: str, doc_hash: str) -> Optional[str]:
+        """Checkpoint file for a document version, or None if checkpointing is off"""
+        if not self.embed_cache_dir:
+            return None
+        return os.path.join(self.embed_cache_dir, f"{doc_id}_{doc_hash}.npy")
+    
+    def _load_checkpoint(self, doc_id: str, doc_hash: str, num_chunks: int) -> Optional[np.ndarray]:
+        """Load a document's checkpointed embeddings if present and complete"""
+        path = self._checkpoint_path(doc_id, doc_hash)
+        if not path or not num_chunks or not os.path.exists(path):
+            return None
+        try:
+            embeddings = np.load(path, allow_pickle=False)
+        except Exception as e:
+            logger.warning("⚠️ Ignoring unreadable embedding checkpoint %s: %s", path, e)
+            return None
+        if len(embeddings) != num_chunks:
+            return None
+        logger.info("♻️ Loaded %d embeddings from checkpoint %s", num_chunks, path)
+        return embeddings
+    
+    def _save_checkpoint(self, doc_id: str, doc_hash: str, embeddings: List[np.ndarray]):
+        """Persist a document's embeddings so a failed DB write doesn't cost a re-encode"""
+        path = self._checkpoint_path(doc_id, doc_hash)
+        if not path or not embeddings:
+            return
+        try:
+            np.save(path, np.vstack(embeddings), allow_pickle=False)
+        except Exception as e:
+            logger.warning("⚠️ Could not write embedding checkpoint %s: %s", path, e)
+    
+    def _remove_checkpoint(self, doc_id: str, doc_hash: str):
+        """Delete a document's checkpoint once its embeddings are stored"""
+        path = self._checkpoint_path(doc_id, doc_hash)
+        if path and os.path.exists(path):
+            os.remove(path)
+    
+    def _store_document(self, doc: Dict[str, str], doc_hash: str, chunks: List[str],
+                        text_hashes: List[str], embeddings: List[np.ndarray]):
+        """Write a document's chunks and remove any it no longer has"""
+        doc_id = doc['id']
+        doc_name = doc['name']
+        
+        logger.info("📄 Storing: %s (%s)", doc_name, doc_id)
         
         if not chunks:
-            print("   ⚠️ No chunks created, skipping")
+            self.embedding_store.delete_document_chunks(doc_id)
+            logger.warning("⚠️ No chunks created for %s, skipping", doc_name)
             return
         
-        # Step 3: Generate embeddings
-        embeddings = self._generate_embeddings(chunks)
+        # Step 1: Bulk upsert to database, then drop chunks beyond the new count
+        chunk_ids = [f"{doc_id}_chunk_{idx}" for idx in range(len(chunks))]
+        # URLs are extracted once here so queries read them from metadata
+        # instead of regex-scanning chunk text every time
+        metadatas = (
+            {
+                'document_name': doc_name,
+                'chunk_index': idx,
+                'text_hash': text_hash,
+                'urls': WebContentService.find_urls(chunk)
+            }
+            for idx, (chunk, text_hash) in enumerate(zip(chunks, text_hashes))
+        )
+        self.embedding_store.bulk_upsert(doc_id, chunk_ids, chunks, np.vstack(embeddings), metadatas)
+        self.embedding_store.delete_stale_chunks(doc_id, chunk_ids)
         
-        # Step 4: Prepare data for bulk upsert
-        chunk_data = []
-        for idx, (chunk_text, embedding) in enumerate(zip(chunks, embeddings)):
-            chunk_id = f"{doc_id}_chunk_{idx}"
-            text_hash = compute_text_hash(chunk_text)
-            
-            chunk_data.append({
-                'chunk_id': chunk_id,
-                'document_id': doc_id,
-                'content': chunk_text,
-                'embedding': embedding,
-                'metadata': {
-                    'document_name': doc_name,
-                    'chunk_index': idx,
-                    'text_hash': text_hash
-                }
-            })
-        
-        # Step 5: Bulk upsert to database
-        self.embedding_store.bulk_upsert(chunk_data)
-        
-        # Step 6: Update document metadata
+        # Step 2: Update document metadata
         self.embedding_store.update_document_metadata(
             document_id=doc_id,
             document_name=doc_name,
@@ -239,8 +432,7 @@ class EmbeddingPipeline:
             chunk_count=len(chunks)
         )
         
-        print(f"   ✅ Stored {len(chunk_data)} embeddings in database\n")
-
+        logger.info("✅ Stored %d embeddings for %s", len(chunk_ids), doc_name)
 
 def main():
     """Main entry point for CLI"""
@@ -255,20 +447,20 @@ def main():
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(message)s')
+    
     try:
         pipeline = EmbeddingPipeline()
         pipeline.process_documents(force_rebuild=args.force_rebuild)
     except KeyboardInterrupt:
-        print("\n\n⚠️ Pipeline interrupted by user")
+        logger.warning("⚠️ Pipeline interrupted by user")
         sys.exit(1)
     except Exception as e:
-        print(f"\n❌ Pipeline failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Pipeline failed: %s", e)
         sys.exit(1)
     finally:
         # Cleanup
-        print("🧹 Cleaning up...")
+        logger.info("🧹 Cleaning up...")
         if 'pipeline' in locals():
             pipeline.embedding_store.close()
 
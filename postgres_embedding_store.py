@@ -4,18 +4,43 @@ Replaces JSON cache with persistent database storage.
 """
 
 import os
-import json
 import hashlib
-from typing import List, Dict, Optional, Any
+import io
+import json
+import logging
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import repeat
+from typing import List, Dict, Optional, Any, Iterable, Iterator
 import psycopg2
-from psycopg2.extras import execute_batch, RealDictCursor
-from psycopg2.extensions import register_adapter, AsIs
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import execute_values, Json, RealDictCursor
 import numpy as np
+import xxhash
+from pgvector.psycopg2 import register_vector
+
+logger = logging.getLogger(__name__)
+
+# Output size of sentence-transformers/all-MiniLM-L6-v2, the model that both
+# embed_pipeline and rag_pipeline_postgres encode with. The vector column,
+# the halfvec casts and the HNSW index in supabase_schema.sql must match it.
+EMBEDDING_DIMENSION = 384
+
+
+# Marks xxh3 hashes. Rows written before the switch from SHA-256 hold
+# unprefixed 16-char SHA-256 hashes; the compute_legacy_* functions
+# reproduce those so existing rows still match instead of being re-embedded.
+HASH_PREFIX = 'x3-'
 
 
 def compute_text_hash(text: str) -> str:
-    """Compute stable hash for text content"""
-    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    """Compute stable hash for text content (xxh3, a fast non-cryptographic hash)"""
+    return HASH_PREFIX + xxhash.xxh3_64_hexdigest(text.encode('utf-8'))
 
 
 def compute_document_hash(document: Dict[str, str]) -> str:
@@ -24,27 +49,87 @@ def compute_document_hash(document: Dict[str, str]) -> str:
     content = document.get('content', '')
     
     combined = f"{doc_id}:{compute_text_hash(content)}"
+    return HASH_PREFIX + xxhash.xxh3_64_hexdigest(combined.encode('utf-8'))
+
+
+def is_legacy_hash(value: str) -> bool:
+    """True for a hash written by the old SHA-256 scheme"""
+    return not value.startswith(HASH_PREFIX)
+
+
+def compute_legacy_text_hash(text: str) -> str:
+    """The pre-xxh3 text hash, for matching rows that still carry it"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+def compute_legacy_document_hash(document: Dict[str, str]) -> str:
+    """The pre-xxh3 document fingerprint, for matching rows that still carry it"""
+    combined = f"{document.get('id', '')}:{compute_legacy_text_hash(document.get('content', ''))}"
     return hashlib.sha256(combined.encode('utf-8')).hexdigest()[:16]
 
 
-def adapt_numpy_array(numpy_array):
-    """Adapter to convert numpy arrays to PostgreSQL arrays"""
-    return AsIs(f"ARRAY{numpy_array.tolist()}")
+def compute_cache_key(text: str, model_name: str, config_version: str = '1') -> str:
+    """
+    Compute the embedding_cache key for a text.
+    
+    The model name and embedding configuration version are part of the key,
+    so switching either makes old entries unreachable without a purge.
+    """
+    combined = f"{model_name}:{config_version}:{text}"
+    return xxhash.xxh3_64_hexdigest(combined.encode('utf-8'))
 
 
-# Register numpy array adapter
-register_adapter(np.ndarray, adapt_numpy_array)
+class _StoreConnection(psycopg2.extensions.connection):
+    """Pooled connection that tracks its one-time setup and prepared statements"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initialized = False
+        self.prepared = set()
 
 
 class PostgresEmbeddingStore:
     """
     Persistent embedding storage using PostgreSQL + pgvector.
-    Provides the same interface as JSONEmbeddingStore for compatibility.
     """
     
+    COPY_THRESHOLD = 2000  # bulk_upsert switches from INSERT to COPY above this many rows
+    HNSW_EF_SEARCH = 40  # hnsw.ef_search used by cosine_similarity_search
+    STREAM_ITERSIZE = 2000  # Rows per round trip for server-side (streaming) cursors
+    GET_CACHE_SIZE = 8192  # Embeddings kept in memory by get()
+    MAX_CONNECTIONS = 8  # Pool size; one connection per concurrent caller
+    CONNECT_RETRIES = 3  # Attempts to obtain a working connection before giving up
+    POOL_WAIT_SECONDS = 30  # How long a caller queues for a free connection
+    INDEX_REBUILD_THRESHOLD = 1000  # Rows an ingest_context() must write before the index is rebuilt
+    VECTOR_INDEX = 'idx_embeddings_vector'  # HNSW index from supabase_schema.sql
+    
+    # Hot-path queries prepared once per connection: name -> (parameter types, SQL)
+    PREPARED_STATEMENTS = {
+        'get_embedding': (
+            ['text'],
+            "SELECT embedding FROM embedding_cache WHERE cache_key = $1"
+        ),
+        # Distances use the halfvec expression the HNSW index is built on.
+        # Pure ORDER BY ... LIMIT top-k; the score threshold is applied by the caller.
+        'similarity_search': (
+            ['vector', 'int'],
+            f"""
+            SELECT 
+                chunk_id,
+                document_id,
+                content,
+                1 - (embedding::halfvec({EMBEDDING_DIMENSION}) <=> $1::halfvec({EMBEDDING_DIMENSION})) as score,
+                metadata
+            FROM document_embeddings
+            ORDER BY embedding::halfvec({EMBEDDING_DIMENSION}) <=> $1::halfvec({EMBEDDING_DIMENSION})
+            LIMIT $2
+            """
+        ),
+    }
+    
     def __init__(self, connection_string: Optional[str] = None):
         """
-        Initialize PostgreSQL connection.
+        Initialize the PostgreSQL connection pool.
         
         Args:
             connection_string: PostgreSQL connection URL (defaults to SUPABASE_DATABASE_URL env var)
@@ -53,131 +138,442 @@ class PostgresEmbeddingStore:
         if not self.connection_string:
             raise ValueError("SUPABASE_DATABASE_URL environment variable not set")
         
-        self.conn = None
+        self._use_prepared = True  # Cleared if the server can't keep them (e.g. transaction pooling)
+        # cache_key -> get() result, least recently used first; shared by every
+        # thread using the store, so only touched under _get_cache_lock
+        self._get_cache: OrderedDict = OrderedDict()
+        self._get_cache_lock = threading.Lock()
+        # ingest_context() state: rows written so far (None outside a context)
+        self._ingest_rows: Optional[int] = None
+        self._ingest_base_rows = 0
+        self._index_dropped = False
+        self._pool = None
+        # One slot per pooled connection; callers wait here instead of getting PoolError
+        self._slots = threading.BoundedSemaphore(self.MAX_CONNECTIONS)
         self._connect()
     
     def _connect(self):
-        """Establish database connection"""
+        """Create the connection pool, opening its first connection"""
         try:
-            self.conn = psycopg2.connect(self.connection_string)
-            print("✅ Connected to Supabase PostgreSQL database")
+            self._pool = ThreadedConnectionPool(
+                minconn=1,
+                maxconn=self.MAX_CONNECTIONS,
+                dsn=self.connection_string,
+                connection_factory=_StoreConnection
+            )
+            logger.info("✅ Connected to Supabase PostgreSQL database")
         except Exception as e:
-            print(f"❌ Failed to connect to PostgreSQL: {str(e)}")
+            logger.error("❌ Failed to connect to PostgreSQL: %s", e)
             raise
     
-    def _ensure_connection(self):
-        """Ensure database connection is alive"""
-        if self.conn is None or self.conn.closed:
-            self._connect()
+    def _prepare_connection(self, conn: '_StoreConnection'):
+        """One-time setup for each new pooled connection"""
+        # Send ndarrays as vector literals and read vector columns back
+        # as float32 ndarrays, with no float[] -> vector cast in between
+        register_vector(conn)
+        
+        # HNSW candidate list size: higher improves recall, lower is faster
+        with conn.cursor() as cur:
+            cur.execute("SET hnsw.ef_search = %s", (self.HNSW_EF_SEARCH,))
+        conn.commit()
+        conn.initialized = True
     
-    def get(self, text_hash: str) -> Optional[Dict[str, Any]]:
+    @contextmanager
+    def _connection(self) -> Iterator['_StoreConnection']:
+        """
+        Check a connection out of the pool for one operation.
+        
+        ThreadedConnectionPool.getconn() raises PoolError instead of waiting
+        when every connection is in use, so callers first take one of
+        MAX_CONNECTIONS semaphore slots and queue there for up to
+        POOL_WAIT_SECONDS. Dead connections are discarded and replaced, with
+        exponential backoff between attempts. If the operation fails, its
+        transaction is rolled back; if the failure was a connection error, the
+        connection is closed rather than returned to the pool.
+        """
+        if not self._slots.acquire(timeout=self.POOL_WAIT_SECONDS):
+            raise PoolError(f"no PostgreSQL connection free after {self.POOL_WAIT_SECONDS}s")
+        try:
+            if self._pool is None or self._pool.closed:
+                self._connect()
+            
+            delay = 0.5
+            for attempt in range(self.CONNECT_RETRIES):
+                conn = None
+                try:
+                    conn = self._pool.getconn()
+                    if conn.closed:
+                        raise psycopg2.InterfaceError("connection already closed")
+                    if not conn.initialized:
+                        self._prepare_connection(conn)
+                    break
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    if conn is not None:
+                        self._pool.putconn(conn, close=True)
+                    if attempt == self.CONNECT_RETRIES - 1:
+                        raise
+                    logger.warning("⚠️ PostgreSQL connection failed, retrying in %ss: %s", delay, e)
+                    time.sleep(delay)
+                    delay *= 2
+                except Exception:
+                    if conn is not None:
+                        self._pool.putconn(conn, close=True)
+                    raise
+            
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self._pool.putconn(conn, close=True)
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                self._pool.putconn(conn)
+                raise
+            else:
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+    
+    def _execute_prepared(self, conn: '_StoreConnection', cur, name: str, params: tuple):
+        """
+        Run one of PREPARED_STATEMENTS, preparing it on first use per connection.
+        
+        If the server rejects prepared statements (for example a transaction-mode
+        pooler that routes EXECUTE to a different backend), prepared execution is
+        switched off for this store and the same SQL runs as a plain query.
         """
-        Retrieve cached embedding by text hash.
+        param_types, sql = self.PREPARED_STATEMENTS[name]
+        
+        if self._use_prepared:
+            try:
+                if name not in conn.prepared:
+                    cur.execute(f"PREPARE {name} ({', '.join(param_types)}) AS {sql}")
+                    conn.prepared.add(name)
+                cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+                return
+            except psycopg2.Error as e:
+                if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                    raise
+                conn.rollback()
+                self._use_prepared = False
+                logger.warning("⚠️ Prepared statements unavailable, using plain queries: %s", e)
+        
+        # $n placeholders -> named psycopg2 parameters (a parameter may repeat)
+        plain_sql = re.sub(r'\$(\d+)', r'%(p\1)s', sql)
+        cur.execute(plain_sql, {f"p{i}": value for i, value in enumerate(params, start=1)})
+    
+    def _get_cache_put(self, cache_key: str, entry: Dict[str, Any]):
+        """Remember a get() result, evicting the least recently used entries"""
+        with self._get_cache_lock:
+            self._get_cache[cache_key] = entry
+            self._get_cache.move_to_end(cache_key)
+            while len(self._get_cache) > self.GET_CACHE_SIZE:
+                self._get_cache.popitem(last=False)
+    
+    def get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve cached embedding from the embedding_cache table.
         
         Args:
-            text_hash: SHA-256 hash of the text content
+            cache_key: Key from compute_cache_key()
             
         Returns:
             Dict with 'embedding' key if found, None otherwise
         """
-        self._ensure_connection()
+        with self._get_cache_lock:
+            cached = self._get_cache.get(cache_key)
+            if cached is not None:
+                self._get_cache.move_to_end(cache_key)
+                return cached
+        
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    "SELECT embedding FROM document_embeddings WHERE chunk_id = %s",
-                    (text_hash,)
-                )
+            with self._connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                self._execute_prepared(conn, cur, 'get_embedding', (cache_key,))
                 result = cur.fetchone()
                 if result:
-                    # Convert pgvector format to list
-                    embedding = result['embedding']
-                    if isinstance(embedding, str):
-                        # Parse string representation if needed
-                        embedding = json.loads(embedding.replace('[', '').replace(']', ''))
-                    return {'embedding': list(embedding)}
+                    # register_vector returns vector columns as ndarrays
+                    entry = {'embedding': result['embedding'].tolist()}
+                    self._get_cache_put(cache_key, entry)
+                    return entry
                 return None
         except Exception as e:
-            print(f"⚠️ Error retrieving embedding from PostgreSQL: {str(e)}")
+            logger.warning("⚠️ Error retrieving embedding from PostgreSQL: %s", e)
             return None
     
-    def upsert(self, text_hash: str, embedding: List[float], metadata: Optional[Dict] = None):
+    def get_many(self, cache_keys: List[str]) -> Dict[str, List[float]]:
         """
-        Store or update a single embedding.
+        Retrieve many cached embeddings in one round trip.
+        
+        Keys already in the in-process LRU are served from it; the rest are
+        fetched with a single ANY(...) query instead of one get() per key.
         
         Args:
-            text_hash: SHA-256 hash of the text content (used as chunk_id)
-            embedding: 768-dim embedding vector
+            cache_keys: Keys from compute_cache_key()
+            
+        Returns:
+            Dict mapping cache_key to embedding, for the keys that are cached
+        """
+        found = {}
+        missing = []
+        with self._get_cache_lock:
+            for cache_key in dict.fromkeys(cache_keys):
+                cached = self._get_cache.get(cache_key)
+                if cached is not None:
+                    self._get_cache.move_to_end(cache_key)
+                    found[cache_key] = cached['embedding']
+                else:
+                    missing.append(cache_key)
+        
+        if not missing:
+            return found
+        
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "SELECT cache_key, embedding FROM embedding_cache WHERE cache_key = ANY(%s)",
+                    (missing,)
+                )
+                for cache_key, embedding in cur:
+                    entry = {'embedding': embedding.tolist()}
+                    self._get_cache_put(cache_key, entry)
+                    found[cache_key] = entry['embedding']
+        except Exception as e:
+            logger.warning("⚠️ Error retrieving embeddings from PostgreSQL: %s", e)
+        return found
+    
+    def upsert(self, cache_key: str, embedding: List[float], metadata: Optional[Dict] = None):
+        """
+        Store or update a single embedding in the embedding_cache table.
+        
+        Cache entries live apart from document_embeddings, so they never
+        show up in (or slow down) retrieval queries.
+        
+        Args:
+            cache_key: Key from compute_cache_key()
+            embedding: Embedding vector
             metadata: Optional metadata dict
         """
-        self._ensure_connection()
         try:
-            with self.conn.cursor() as cur:
-                # For cache compatibility, store with hash as both chunk_id and document_id
-                cur.execute("""
-                    INSERT INTO document_embeddings 
-                        (chunk_id, document_id, content, embedding, metadata)
-                    VALUES (%s, %s, %s, %s, %s::jsonb)
-                    ON CONFLICT (chunk_id) 
-                    DO UPDATE SET 
-                        embedding = EXCLUDED.embedding,
-                        metadata = EXCLUDED.metadata,
-                        updated_at = NOW()
-                """, (
-                    text_hash,
-                    metadata.get('document_id', 'cache') if metadata else 'cache',
-                    metadata.get('content', '') if metadata else '',
-                    embedding,
-                    json.dumps(metadata) if metadata else '{}'
-                ))
-            self.conn.commit()
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO embedding_cache (cache_key, embedding, metadata)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (cache_key) 
+                        DO UPDATE SET 
+                            embedding = EXCLUDED.embedding,
+                            metadata = EXCLUDED.metadata
+                    """, (
+                        cache_key,
+                        np.asarray(embedding, dtype=np.float32),
+                        Json(metadata or {})
+                    ))
+                conn.commit()
         except Exception as e:
-            self.conn.rollback()
-            print(f"⚠️ Error upserting embedding to PostgreSQL: {str(e)}")
+            logger.error("⚠️ Error upserting embedding to PostgreSQL: %s", e)
             raise
+        finally:
+            # Dropped after the write too, so a get() racing the upsert
+            # cannot leave the old embedding cached
+            with self._get_cache_lock:
+                self._get_cache.pop(cache_key, None)
     
-    def bulk_upsert(self, items: List[Dict[str, Any]]):
+    def bulk_upsert(self, document_id: str, chunk_ids: List[str], contents: List[str],
+                    embeddings: np.ndarray, metadatas: Iterable[Dict[str, Any]]):
         """
-        Bulk insert/update embeddings efficiently.
+        Bulk insert/update one document's embeddings efficiently.
+        
+        Columns are passed as parallel sequences and only zipped into rows
+        for the final write. Batches above COPY_THRESHOLD rows are streamed
+        with COPY into a temp table and merged from there; smaller ones use
+        multi-row INSERTs via execute_values.
         
         Args:
-            items: List of dicts with 'chunk_id', 'document_id', 'content', 'embedding', 'metadata'
+            document_id: Document the chunks belong to
+            chunk_ids: Chunk identifiers
+            contents: Chunk texts, aligned with chunk_ids
+            embeddings: (len(chunk_ids), dim) embedding matrix
+            metadatas: Metadata dicts aligned with chunk_ids (may be a generator)
         """
-        self._ensure_connection()
-        if not items:
+        if not chunk_ids:
             return
         
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        
+        if self._ingest_rows is not None:
+            self._ingest_rows += len(chunk_ids)
+            if not self._index_dropped and self._ingest_rows > max(self.INDEX_REBUILD_THRESHOLD, self._ingest_base_rows):
+                self.drop_vector_index()
+                self._index_dropped = True
+        
         try:
-            with self.conn.cursor() as cur:
-                # Prepare data tuples
-                data = [
-                    (
-                        item['chunk_id'],
-                        item['document_id'],
-                        item['content'],
-                        item['embedding'],
-                        json.dumps(item.get('metadata', {}))
-                    )
-                    for item in items
-                ]
-                
-                # Batch insert/update
-                execute_batch(cur, """
-                    INSERT INTO document_embeddings 
-                        (chunk_id, document_id, content, embedding, metadata)
-                    VALUES (%s, %s, %s, %s, %s::jsonb)
-                    ON CONFLICT (chunk_id) 
-                    DO UPDATE SET 
-                        embedding = EXCLUDED.embedding,
-                        content = EXCLUDED.content,
-                        metadata = EXCLUDED.metadata,
-                        updated_at = NOW()
-                """, data, page_size=100)
-                
-            self.conn.commit()
-            print(f"✅ Bulk upserted {len(items)} embeddings to PostgreSQL")
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    if len(chunk_ids) > self.COPY_THRESHOLD:
+                        self._copy_upsert(cur, document_id, chunk_ids, contents, embeddings, metadatas)
+                    else:
+                        execute_values(cur, """
+                            INSERT INTO document_embeddings 
+                                (chunk_id, document_id, content, embedding, metadata)
+                            VALUES %s
+                            ON CONFLICT (chunk_id) 
+                            DO UPDATE SET 
+                                embedding = EXCLUDED.embedding,
+                                content = EXCLUDED.content,
+                                metadata = EXCLUDED.metadata,
+                                updated_at = NOW()
+                        """, zip(
+                            chunk_ids,
+                            repeat(document_id),
+                            contents,
+                            embeddings,
+                            map(Json, metadatas)
+                        ), template="(%s, %s, %s, %s, %s)", page_size=1000)
+                    
+                conn.commit()
+            logger.debug("✅ Bulk upserted %d embeddings to PostgreSQL", len(chunk_ids))
         except Exception as e:
-            self.conn.rollback()
-            print(f"❌ Error bulk upserting to PostgreSQL: {str(e)}")
+            logger.error("❌ Error bulk upserting to PostgreSQL: %s", e)
+            raise
+    
+    @staticmethod
+    def _copy_upsert(cur, document_id: str, chunk_ids: List[str], contents: List[str],
+                     embeddings: np.ndarray, metadatas: Iterable[Dict[str, Any]]):
+        """COPY rows into a transaction-scoped temp table, then upsert them in one statement"""
+        # Binary COPY: the whole matrix is converted to big-endian float4 bytes
+        # once and sliced per row in pgvector's wire format (int16 dim, int16
+        # unused, floats), instead of formatting 384 floats as text per row
+        dim = embeddings.shape[1]
+        row_size = dim * 4
+        raw = np.ascontiguousarray(embeddings, dtype='>f4').tobytes()
+        vector_prefix = struct.pack('>ihh', row_size + 4, dim, 0)
+        document_field = PostgresEmbeddingStore._copy_field(document_id.encode('utf-8'))
+        
+        buffer = io.BytesIO()
+        buffer.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+        for i, (chunk_id, content, metadata) in enumerate(zip(chunk_ids, contents, metadatas)):
+            buffer.write(struct.pack('>h', 5))
+            buffer.write(PostgresEmbeddingStore._copy_field(chunk_id.encode('utf-8')))
+            buffer.write(document_field)
+            buffer.write(PostgresEmbeddingStore._copy_field(content.encode('utf-8')))
+            buffer.write(vector_prefix)
+            buffer.write(raw[i * row_size:(i + 1) * row_size])
+            # jsonb binary format: version byte 1 followed by the JSON text
+            buffer.write(PostgresEmbeddingStore._copy_field(b'\x01' + json.dumps(metadata).encode('utf-8')))
+        buffer.write(struct.pack('>h', -1))
+        buffer.seek(0)
+        
+        cur.execute("""
+            CREATE TEMP TABLE document_embeddings_staging
+                (chunk_id TEXT, document_id TEXT, content TEXT, embedding vector, metadata JSONB)
+            ON COMMIT DROP
+        """)
+        cur.copy_expert("""
+            COPY document_embeddings_staging (chunk_id, document_id, content, embedding, metadata)
+            FROM STDIN WITH (FORMAT BINARY)
+        """, buffer)
+        cur.execute("""
+            INSERT INTO document_embeddings 
+                (chunk_id, document_id, content, embedding, metadata)
+            SELECT chunk_id, document_id, content, embedding, metadata
+            FROM document_embeddings_staging
+            ON CONFLICT (chunk_id) 
+            DO UPDATE SET 
+                embedding = EXCLUDED.embedding,
+                content = EXCLUDED.content,
+                metadata = EXCLUDED.metadata,
+                updated_at = NOW()
+        """)
+    
+    @staticmethod
+    def _copy_field(value: bytes) -> bytes:
+        """Encode one length-prefixed field for binary COPY"""
+        return struct.pack('>i', len(value)) + value
+    
+    @contextmanager
+    def ingest_context(self) -> Iterator[None]:
+        """
+        Scope a (possibly) large ingest so the HNSW index is built once at the end.
+        
+        Inserting into a populated HNSW index is far slower than building it
+        over the finished table. Inside this context, once bulk_upsert() has
+        written more than INDEX_REBUILD_THRESHOLD rows and more rows than the
+        table held on entry, the vector index is dropped; it is rebuilt on
+        exit, even if the ingest fails. Small incremental ingests keep the
+        index in place, where a full rebuild would cost more than it saves.
+        """
+        self._ingest_rows = 0
+        self._ingest_base_rows = self._estimate_row_count()
+        try:
+            yield
+        finally:
+            self._ingest_rows = None
+            if self._index_dropped:
+                self._index_dropped = False
+                self.build_vector_index()
+    
+    def _estimate_row_count(self) -> int:
+        """Planner estimate of document_embeddings rows (no table scan)"""
+        try:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'document_embeddings'::regclass")
+                result = cur.fetchone()
+                # reltuples is -1 until the table is first vacuumed/analyzed
+                return max(result[0], 0) if result else 0
+        except Exception as e:
+            logger.warning("⚠️ Error estimating table size: %s", e)
+            return 0
+    
+    def drop_vector_index(self):
+        """Drop the HNSW vector index ahead of a large bulk load"""
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP INDEX IF EXISTS {self.VECTOR_INDEX}")
+                conn.commit()
+            logger.info("🗑️ Dropped vector index %s for bulk load", self.VECTOR_INDEX)
+        except Exception as e:
+            logger.error("❌ Error dropping vector index: %s", e)
+            raise
+    
+    def build_vector_index(self, m: int = 16, ef_construction: int = 64):
+        """
+        (Re)build the HNSW vector index without blocking concurrent reads or writes.
+        
+        Args:
+            m: Max connections per HNSW graph node
+            ef_construction: Candidate list size while building the graph
+        """
+        start = time.time()
+        try:
+            with self._connection() as conn:
+                # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        # A failed or cancelled CONCURRENTLY build leaves an INVALID
+                        # index that IF NOT EXISTS would keep skipping; drop it first
+                        cur.execute(
+                            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                            (self.VECTOR_INDEX,)
+                        )
+                        row = cur.fetchone()
+                        if row is not None and not row[0]:
+                            logger.warning("⚠️ Dropping invalid vector index %s left by an earlier build", self.VECTOR_INDEX)
+                            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.VECTOR_INDEX}")
+                        
+                        cur.execute(f"""
+                            CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.VECTOR_INDEX}
+                            ON document_embeddings
+                            USING hnsw ((embedding::halfvec({EMBEDDING_DIMENSION})) halfvec_cosine_ops)
+                            WITH (m = %s, ef_construction = %s)
+                        """, (int(m), int(ef_construction)))
+                finally:
+                    conn.autocommit = False
+            logger.info("✅ Built vector index %s in %.1fs", self.VECTOR_INDEX, time.time() - start)
+        except Exception as e:
+            logger.error("❌ Error building vector index: %s", e)
             raise
     
     def get_all_document_hashes(self) -> Dict[str, str]:
@@ -187,16 +583,71 @@ class PostgresEmbeddingStore:
         Returns:
             Dict mapping document_id to document_hash
         """
-        self._ensure_connection()
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # Server-side cursor: rows arrive STREAM_ITERSIZE at a time straight
+            # into the dict instead of as one fully materialized result
+            with self._connection() as conn, conn.cursor(name='document_hashes') as cur:
+                cur.itersize = self.STREAM_ITERSIZE
                 cur.execute("SELECT document_id, document_hash FROM document_metadata")
-                results = cur.fetchall()
-                return {row['document_id']: row['document_hash'] for row in results}
+                return dict(cur)
+        except Exception as e:
+            logger.warning("⚠️ Error retrieving document hashes: %s", e)
+            return {}
+    
+    def get_chunk_embeddings_by_hash(self, text_hashes: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Get stored embeddings for chunk text hashes, from any document.
+        
+        Lets the pipeline reuse embeddings for chunks whose text is unchanged
+        or repeated across documents (shared headers, copies, versions).
+        
+        Args:
+            text_hashes: Chunk text hashes to look up
+            
+        Returns:
+            Dict mapping text_hash to float32 embedding vector, for the
+            hashes that are already stored
+        """
+        if not text_hashes:
+            return {}
+        
+        try:
+            with self._connection() as conn, conn.cursor(name='chunk_embeddings') as cur:
+                cur.itersize = self.STREAM_ITERSIZE
+                cur.execute("""
+                    SELECT DISTINCT ON (metadata->>'text_hash')
+                        metadata->>'text_hash', embedding
+                    FROM document_embeddings
+                    WHERE metadata->>'text_hash' = ANY(%s)
+                """, (list(text_hashes),))
+                return dict(cur)
         except Exception as e:
-            print(f"⚠️ Error retrieving document hashes: {str(e)}")
+            logger.warning("⚠️ Error retrieving chunk embeddings: %s", e)
             return {}
     
+    def delete_stale_chunks(self, document_id: str, keep_chunk_ids: List[str]):
+        """
+        Delete a document's chunks that are not in keep_chunk_ids.
+        
+        Args:
+            document_id: Document identifier
+            keep_chunk_ids: Chunk IDs that were just written for the document
+        """
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM document_embeddings WHERE document_id = %s AND NOT (chunk_id = ANY(%s))",
+                        (document_id, list(keep_chunk_ids))
+                    )
+                    deleted_count = cur.rowcount
+                conn.commit()
+            if deleted_count:
+                logger.debug("🗑️ Deleted %d stale chunks for document: %s", deleted_count, document_id)
+        except Exception as e:
+            logger.error("❌ Error deleting stale chunks: %s", e)
+            raise
+    
     def delete_document_chunks(self, document_id: str):
         """
         Delete all chunks for a specific document.
@@ -204,19 +655,18 @@ class PostgresEmbeddingStore:
         Args:
             document_id: Document identifier
         """
-        self._ensure_connection()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    "DELETE FROM document_embeddings WHERE document_id = %s",
-                    (document_id,)
-                )
-                deleted_count = cur.rowcount
-            self.conn.commit()
-            print(f"🗑️ Deleted {deleted_count} chunks for document: {document_id}")
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM document_embeddings WHERE document_id = %s",
+                        (document_id,)
+                    )
+                    deleted_count = cur.rowcount
+                conn.commit()
+            logger.debug("🗑️ Deleted %d chunks for document: %s", deleted_count, document_id)
         except Exception as e:
-            self.conn.rollback()
-            print(f"❌ Error deleting document chunks: {str(e)}")
+            logger.error("❌ Error deleting document chunks: %s", e)
             raise
     
     def update_document_metadata(self, document_id: str, document_name: str, 
@@ -230,24 +680,23 @@ class PostgresEmbeddingStore:
             document_hash: SHA-256 hash of document content
             chunk_count: Number of chunks created
         """
-        self._ensure_connection()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO document_metadata 
-                        (document_id, document_name, document_hash, chunk_count)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (document_id)
-                    DO UPDATE SET
-                        document_name = EXCLUDED.document_name,
-                        document_hash = EXCLUDED.document_hash,
-                        chunk_count = EXCLUDED.chunk_count,
-                        updated_at = NOW()
-                """, (document_id, document_name, document_hash, chunk_count))
-            self.conn.commit()
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO document_metadata 
+                            (document_id, document_name, document_hash, chunk_count)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (document_id)
+                        DO UPDATE SET
+                            document_name = EXCLUDED.document_name,
+                            document_hash = EXCLUDED.document_hash,
+                            chunk_count = EXCLUDED.chunk_count,
+                            updated_at = NOW()
+                    """, (document_id, document_name, document_hash, chunk_count))
+                conn.commit()
         except Exception as e:
-            self.conn.rollback()
-            print(f"❌ Error updating document metadata: {str(e)}")
+            logger.error("❌ Error updating document metadata: %s", e)
             raise
     
     def cosine_similarity_search(self, query_embedding: List[float], 
@@ -257,35 +706,29 @@ class PostgresEmbeddingStore:
         Perform semantic similarity search using pgvector.
         
         Args:
-            query_embedding: Query vector (768-dim)
+            query_embedding: Query vector (EMBEDDING_DIMENSION floats)
             top_k: Number of results to return
             threshold: Minimum similarity score (0-1)
             
         Returns:
             List of dicts with 'chunk_id', 'document_id', 'content', 'score', 'metadata'
         """
-        self._ensure_connection()
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Use cosine distance operator (<=>)
-                # Convert to similarity score: 1 - distance
-                cur.execute("""
-                    SELECT 
-                        chunk_id,
-                        document_id,
-                        content,
-                        1 - (embedding <=> %s::vector) as score,
-                        metadata
-                    FROM document_embeddings
-                    WHERE 1 - (embedding <=> %s::vector) > %s
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s
-                """, (query_embedding, query_embedding, threshold, query_embedding, top_k))
+            with self._connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Cosine distance (<=>) top-k straight off the HNSW index. Rows
+                # arrive best first, so the threshold just truncates the list;
+                # filtering after LIMIT returns the same rows as filtering before.
+                self._execute_prepared(conn, cur, 'similarity_search', (query_embedding, top_k))
                 
-                results = cur.fetchall()
-                return [dict(row) for row in results]
+                results = []
+                for row in cur:
+                    if row['score'] <= threshold:
+                        break
+                    results.append(dict(row))
+                return results
         except Exception as e:
-            print(f"❌ Error performing similarity search: {str(e)}")
+            logger.error("❌ Error performing similarity search: %s", e)
             return []
     
     def get_stats(self) -> Dict[str, Any]:
@@ -295,9 +738,8 @@ class PostgresEmbeddingStore:
         Returns:
             Dict with total_documents, total_chunks, avg_chunks_per_doc
         """
-        self._ensure_connection()
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+            with self._connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute("""
                     SELECT 
                         COUNT(DISTINCT document_id) as total_documents,
@@ -308,14 +750,14 @@ class PostgresEmbeddingStore:
                 stats = cur.fetchone()
                 return dict(stats) if stats else {}
         except Exception as e:
-            print(f"⚠️ Error retrieving stats: {str(e)}")
+            logger.warning("⚠️ Error retrieving stats: %s", e)
             return {}
     
     def close(self):
-        """Close database connection"""
-        if self.conn and not self.conn.closed:
-            self.conn.close()
-            print("✅ Closed PostgreSQL connection")
+        """Close all pooled database connections"""
+        if self._pool and not self._pool.closed:
+            self._pool.closeall()
+            logger.debug("✅ Closed PostgreSQL connection")
     
     def __enter__(self):
         return self
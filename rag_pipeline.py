@@ -1,19 +1,86 @@
 import os
 import re
 import time
-from typing import List, Dict, Optional
+import random
+import heapq
+import threading
+import logging
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Optional, Iterator, Tuple, Union
+import xxhash
 from google import genai
 from google.genai import types
 from web_content_service import WebContentService
 
+try:
+    import numpy as np
+    import torch
+    from sentence_transformers import SentenceTransformer  # type: ignore
+    EMBEDDING_MODEL_AVAILABLE = True
+except ImportError:
+    EMBEDDING_MODEL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+SENTENCE_BREAK_PATTERN = re.compile(r'[.!?] ')
+SPACE_PATTERN = re.compile(' ')
+WORD_PATTERN = re.compile(r'\w+')
+NO_INFO_PATTERN = re.compile(r'no (?:relevant )?information found|not enough information', re.IGNORECASE)
+STOP_WORDS = frozenset({'the', 'is', 'at', 'which', 'on', 'a', 'an', 'and', 'or', 'but', 'in', 'with', 'to', 'for', 'of', 'as', 'by', 'from'})
+
 class RAGPipeline:
     """Simplified RAG pipeline for document-based Q&A using Gemini AI"""
     
-    def __init__(self, gemini_api_key: str, use_extended_knowledge: bool = True):
+    GEMINI_MODEL = "gemini-2.0-flash-exp"
+    MAX_CONCURRENT_QUERIES = 4  # Speculative fallback requests in flight at once
+    GEMINI_TIMEOUT_MS = 30_000  # Per-request HTTP timeout for Gemini calls
+    MAX_RETRY_DELAY = 16  # Seconds; cap for the exponential retry backoff
+    EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'  # Same model as the pgvector pipeline
+    ENCODE_BATCH_SIZE = 64  # Chunks per forward pass on CPU
+    GPU_ENCODE_BATCH_SIZE = 256  # Larger batches keep a GPU busy
+    RESULT_CACHE_SIZE = 512  # Entries kept by each of the retrieval and response caches
+    RRF_K = 60  # Reciprocal rank fusion damping constant
+    RRF_CANDIDATES = 50  # Chunks taken from each ranking before fusion
+    DENSE_WEIGHT = 0.6  # Weight of the embedding ranking in the fused score
+    KEYWORD_WEIGHT = 0.4  # Weight of the keyword ranking in the fused score
+    # Chunk relevance gates, per score scale. A chunk passes when either its
+    # keyword fraction or its cosine similarity clears the threshold.
+    KEYWORD_URL_THRESHOLD = 0.2  # Keyword fraction for scanning a chunk for URLs
+    KEYWORD_RELEVANCE_THRESHOLD = 0.4  # Keyword fraction for using a chunk as context
+    DENSE_URL_THRESHOLD = 0.3  # Cosine similarity for URL scanning (as RAGPipelinePostgres)
+    DENSE_RELEVANCE_THRESHOLD = 0.5  # Cosine similarity for context (as RAGPipelinePostgres)
+    
+    def __init__(self, gemini_api_key: str, use_extended_knowledge: bool = True,
+                 speculative_fallback: bool = False):
+        """
+        Args:
+            gemini_api_key: API key for Gemini
+            use_extended_knowledge: Fall back to general knowledge when documents don't answer
+            speculative_fallback: Request the general-knowledge answer alongside every
+                context-grounded one, so a fallback costs no extra round trip (at the
+                price of a second Gemini call per grounded query)
+        """
         self.gemini_api_key = gemini_api_key
         self.gemini_client = None
+        self.embedding_model = None  # Loaded on first initialize_with_documents
         self.chunks = []  # Store all document chunks
+        self._chunk_texts_lower = []  # Lowercased chunk contents for keyword scoring
+        self._vocabulary = ''  # Keyword terms joined by newlines, for substring search
+        self._term_starts = [0]  # Offset of each term in _vocabulary, plus an end sentinel
+        self._postings = []  # Per term (same order): indexes of chunks containing it
+        self._chunk_embeddings = None  # (n_chunks, dim) unit-norm float32 matrix, if dense retrieval is available
         self.use_extended_knowledge = use_extended_knowledge  # Enable/disable general knowledge fallback
+        # Repeat queries skip retrieval / Gemini; both are cleared when documents are reloaded
+        self._retrieval_cache: OrderedDict = OrderedDict()  # (query, top_k) -> ranked chunks
+        self._response_cache: OrderedDict = OrderedDict()  # query -> final response
+        # The pipeline is shared by all Streamlit sessions, so cache reads and
+        # writes (which reorder the OrderedDicts) are serialized
+        self._cache_lock = threading.Lock()
+        self._fallback_executor = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_QUERIES) if speculative_fallback else None
         
         self._initialize_services()
     
@@ -21,50 +88,58 @@ class RAGPipeline:
         """Initialize Gemini AI client"""
         try:
             # Initialize Gemini client
-            self.gemini_client = genai.Client(api_key=self.gemini_api_key)
-            print("✅ Gemini AI client initialized")
+            self.gemini_client = genai.Client(
+                api_key=self.gemini_api_key,
+                http_options=types.HttpOptions(timeout=self.GEMINI_TIMEOUT_MS)
+            )
+            logger.info("✅ Gemini AI client initialized")
+            self._prewarm_gemini_client()
             
         except Exception as e:
-            print(f"❌ Error initializing RAG pipeline: {str(e)}")
+            logger.error("❌ Error initializing RAG pipeline: %s", e)
             raise
     
     def _chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
         """Split text into overlapping chunks"""
         # Clean and normalize text
-        text = re.sub(r'\s+', ' ', text.strip())
+        text = WHITESPACE_PATTERN.sub(' ', text.strip())
+        text_length = len(text)
         
-        if len(text) <= chunk_size:
+        if text_length <= chunk_size:
             return [text]
         
+        # Index every break candidate in one pass over the text; each window
+        # then finds its last boundary with a binary search instead of
+        # rescanning its 1000 characters
+        sentence_breaks = [m.start() for m in SENTENCE_BREAK_PATTERN.finditer(text)]
+        space_breaks = [m.start() for m in SPACE_PATTERN.finditer(text)]
+        
+        min_sentence_break = chunk_size * 0.5
+        min_word_break = chunk_size * 0.7
         chunks = []
         start = 0
         
-        while start < len(text):
+        while start < text_length:
             # Find the end position
             end = start + chunk_size
             
-            if end >= len(text):
+            if end >= text_length:
                 # Last chunk
                 chunks.append(text[start:])
                 break
             
-            # Try to break at sentence or word boundary
-            chunk_text = text[start:end]
-            
-            # Look for sentence endings
-            last_sentence = max(
-                chunk_text.rfind('. '),
-                chunk_text.rfind('! '),
-                chunk_text.rfind('? ')
-            )
+            # Try to break at sentence boundary (last "[.!?] " fully inside the window)
+            idx = bisect_right(sentence_breaks, end - 2) - 1
+            last_sentence = sentence_breaks[idx] if idx >= 0 else -1
             
-            if last_sentence > chunk_size * 0.5:  # If we found a good sentence break
-                end = start + last_sentence + 1
+            if last_sentence - start > min_sentence_break:  # If we found a good sentence break
+                end = last_sentence + 1
             else:
                 # Look for word boundary
-                last_space = chunk_text.rfind(' ')
-                if last_space > chunk_size * 0.7:  # If we found a good word break
-                    end = start + last_space
+                idx = bisect_right(space_breaks, end - 1) - 1
+                last_space = space_breaks[idx] if idx >= 0 else -1
+                if last_space - start > min_word_break:  # If we found a good word break
+                    end = last_space
             
             chunks.append(text[start:end].strip())
             start = end - overlap
@@ -74,18 +149,32 @@ class RAGPipeline:
     def initialize_with_documents(self, documents: List[Dict[str, str]]):
         """Initialize the RAG pipeline with documents"""
         try:
-            print(f"🔄 Initializing RAG pipeline")
+            logger.info("🔄 Initializing RAG pipeline")
             
             # Process documents and create chunks
             self.chunks = []
+            with self._cache_lock:
+                self._retrieval_cache.clear()
+                self._response_cache.clear()
+            seen_hashes = set()  # xxh3 digests of the chunk texts kept so far
+            duplicate_count = 0
             
             for doc_idx, document in enumerate(documents):
-                print(f"🔄 Processing document: {document['name']}")
+                logger.info("🔄 Processing document: %s", document['name'])
                 
                 # Split document into chunks
                 doc_chunks = self._chunk_text(document['content'])
                 
                 for chunk_idx, chunk in enumerate(doc_chunks):
+                    # Skip exact repeats (headers, signatures, repeated pages).
+                    # Only identical text counts: chunks that differ in just a
+                    # number or date carry different facts and must both be kept.
+                    chunk_hash = xxhash.xxh3_64_intdigest(chunk.encode('utf-8'))
+                    if chunk_hash in seen_hashes:
+                        duplicate_count += 1
+                        continue
+                    seen_hashes.add(chunk_hash)
+                    
                     self.chunks.append({
                         'content': chunk,
                         'document_name': document['name'],
@@ -97,63 +186,229 @@ class RAGPipeline:
             if not self.chunks:
                 raise ValueError("No text chunks extracted from documents")
             
-            print(f"📝 Generated {len(self.chunks)} text chunks")
-            print(f"✅ RAG pipeline initialized with {len(self.chunks)} chunks")
+            self._build_keyword_index()
+            self._build_dense_index()
+            
+            logger.info("📝 Generated %s text chunks (%s duplicates skipped)", len(self.chunks), duplicate_count)
+            logger.info("✅ RAG pipeline initialized with %s chunks", len(self.chunks))
             
         except Exception as e:
-            print(f"❌ Error initializing RAG pipeline: {str(e)}")
+            logger.error("❌ Error initializing RAG pipeline: %s", e)
             raise
     
-    def _simple_relevance_score(self, query: str, text: str) -> float:
-        """Calculate a simple relevance score based on keyword matching"""
+    def _build_keyword_index(self):
+        """
+        Build the term -> chunk postings used by keyword scoring
+        
+        A query keyword is \\w+ text, so any substring match of it in a chunk
+        lies inside one of the chunk's \\w+ terms; looking keywords up
+        against the vocabulary therefore finds exactly the chunks the
+        substring test would, without touching the chunk texts.
+        
+        The terms are also joined into one newline-separated string, so the
+        terms containing a keyword are found with C-level str.find scans
+        instead of a Python loop over the whole vocabulary.
+        """
+        self._chunk_texts_lower = [chunk['content'].lower() for chunk in self.chunks]
+        postings = defaultdict(lambda: array('i'))
+        for idx, text in enumerate(self._chunk_texts_lower):
+            for term in set(WORD_PATTERN.findall(text)):
+                postings[term].append(idx)
+        
+        self._vocabulary = '\n'.join(postings)
+        self._term_starts = [0]
+        for term in postings:
+            self._term_starts.append(self._term_starts[-1] + len(term) + 1)
+        self._postings = list(postings.values())
+    
+    def _terms_containing(self, word: str) -> Iterator[int]:
+        """Yield the index of every vocabulary term that contains word"""
+        pos = self._vocabulary.find(word)
+        while pos != -1:
+            term_idx = bisect_right(self._term_starts, pos) - 1
+            yield term_idx
+            # word has no newline, so the next match is in a later term
+            pos = self._vocabulary.find(word, self._term_starts[term_idx + 1])
+    
+    def _load_embedding_model(self):
+        """Load the sentence-transformers model once, or None if it isn't installed"""
+        if self.embedding_model is None and EMBEDDING_MODEL_AVAILABLE:
+            try:
+                device = 'cuda' if torch.cuda.is_available() else 'cpu'
+                logger.info("🔄 Loading embedding model for semantic retrieval (%s)...", device)
+                self.embedding_model = SentenceTransformer(self.EMBEDDING_MODEL, device=device)
+            except Exception as e:
+                logger.warning("⚠️ Embedding model unavailable, using keyword retrieval: %s", e)
+        return self.embedding_model
+    
+    def _build_dense_index(self):
+        """
+        Embed every chunk once for semantic retrieval
+        
+        Embeddings are L2-normalized, so a query's cosine similarity to all
+        chunks is a single matrix-vector product (a flat inner-product index).
+        Without sentence-transformers the pipeline keeps keyword retrieval.
+        """
+        self._chunk_embeddings = None
+        model = self._load_embedding_model()
+        if model is None:
+            return
+        
+        start = time.time()
+        self._chunk_embeddings = model.encode(
+            [chunk['content'] for chunk in self.chunks],
+            batch_size=self.GPU_ENCODE_BATCH_SIZE if model.device.type == 'cuda' else self.ENCODE_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ).astype(np.float32, copy=False)
+        logger.info("🧠 Embedded %s chunks in %.1fs", len(self.chunks), time.time() - start)
+    
+    def _dense_scores(self, query: str) -> 'np.ndarray':
+        """Cosine similarity of the query to every chunk"""
+        query_embedding = self.embedding_model.encode(
+            [query],
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )[0].astype(np.float32, copy=False)
+        return self._chunk_embeddings @ query_embedding
+    
+    def _hybrid_top_k(self, query: str, top_k: int) -> List[Tuple[int, float, float]]:
+        """
+        Top-k chunks by reciprocal rank fusion of embedding and keyword rankings
+        
+        Each chunk scores DENSE_WEIGHT / (RRF_K + rank) from the embedding
+        ranking plus KEYWORD_WEIGHT / (RRF_K + rank) from the keyword ranking
+        (ranks from 1, RRF_CANDIDATES deep). Embeddings catch paraphrases;
+        keywords catch exact names and codes that embeddings blur. Both raw
+        scores are returned, because a chunk fused in by its keyword rank can
+        have a low cosine similarity and must be judged on its keyword score.
+        
+        Returns:
+            (chunk index, cosine similarity, keyword score) triples, best first
+        """
+        dense_scores = self._dense_scores(query)
+        
+        # argpartition selects the candidates in O(n); only those get sorted
+        candidates = min(self.RRF_CANDIDATES, len(dense_scores))
+        dense_ranked = np.argpartition(-dense_scores, candidates - 1)[:candidates]
+        dense_ranked = dense_ranked[np.argsort(-dense_scores[dense_ranked], kind='stable')]
+        
+        keyword_scores = self._score_chunks(query)
+        keyword_ranked = heapq.nlargest(self.RRF_CANDIDATES, keyword_scores,
+                                        key=lambda idx: (keyword_scores[idx], -idx))
+        
+        fused = defaultdict(float)
+        for rank, idx in enumerate(dense_ranked.tolist(), start=1):
+            fused[idx] += self.DENSE_WEIGHT / (self.RRF_K + rank)
+        for rank, idx in enumerate(keyword_ranked, start=1):
+            fused[idx] += self.KEYWORD_WEIGHT / (self.RRF_K + rank)
+        
+        top = heapq.nlargest(top_k, fused, key=lambda idx: (fused[idx], -idx))
+        return [(idx, float(dense_scores[idx]), keyword_scores.get(idx, 0.0)) for idx in top]
+    
+    def _score_chunks(self, query: str) -> Dict[int, float]:
+        """
+        Keyword relevance scores for the chunks that match a query
+        
+        Score is the fraction of query keywords found in the chunk, plus 0.3
+        for an exact phrase match, capped at 1.0. Chunks matching no keyword
+        score 0 and are left out.
+        
+        Returns:
+            Dict mapping chunk index to score
+        """
         query_lower = query.lower()
-        text_lower = text.lower()
         
         # Extract keywords from query (remove common stop words)
-        stop_words = {'the', 'is', 'at', 'which', 'on', 'a', 'an', 'and', 'or', 'but', 'in', 'with', 'to', 'for', 'of', 'as', 'by', 'from'}
-        query_words = [word for word in re.findall(r'\w+', query_lower) if word not in stop_words and len(word) > 2]
+        query_words = [word for word in WORD_PATTERN.findall(query_lower) if word not in STOP_WORDS and len(word) > 2]
         
         if not query_words:
-            return 0.0
-        
-        # Count keyword matches
-        matches = sum(1 for word in query_words if word in text_lower)
+            return {}
         
-        # Calculate score (percentage of query words found)
-        score = matches / len(query_words)
+        # Count keyword matches via the vocabulary terms containing each keyword
+        matches = Counter()
+        for word in query_words:
+            matching_chunks = set()
+            for term_idx in self._terms_containing(word):
+                matching_chunks.update(self._postings[term_idx])
+            matches.update(matching_chunks)
         
-        # Bonus for exact phrase match
-        if query_lower in text_lower:
-            score += 0.3
+        scores = {}
+        for idx, count in matches.items():
+            # Calculate score (percentage of query words found)
+            score = count / len(query_words)
+            
+            # Bonus for exact phrase match
+            if query_lower in self._chunk_texts_lower[idx]:
+                score += 0.3
+            
+            scores[idx] = min(score, 1.0)  # Cap at 1.0
         
-        return min(score, 1.0)  # Cap at 1.0
+        return scores
     
     def _retrieve_relevant_chunks(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Retrieve the most relevant document chunks for a query using simple keyword matching"""
+        """
+        Retrieve the most relevant document chunks for a query
+        
+        Fuses semantic (embedding) and keyword rankings when the chunk
+        embeddings were built, and uses simple keyword matching otherwise.
+        Every chunk carries its 'keyword_score'; fused results also carry
+        'dense_score' (cosine similarity), which is then their 'score'.
+        """
         if not self.chunks:
             raise ValueError("No documents loaded")
         
+        cached = self._cache_get(self._retrieval_cache, (query, top_k))
+        if cached is not None:
+            return cached
+        
         try:
-            # Calculate relevance scores
-            scored_chunks = []
-            for chunk in self.chunks:
-                score = self._simple_relevance_score(query, chunk['content'])
-                if score > 0:
-                    scored_chunks.append({
-                        **chunk,
-                        'score': score
-                    })
-            
-            # Sort by score
-            scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+            if self._chunk_embeddings is not None:
+                results = [
+                    {**self.chunks[idx], 'score': dense_score, 'dense_score': dense_score, 'keyword_score': keyword_score}
+                    for idx, dense_score, keyword_score in self._hybrid_top_k(query, top_k)
+                ]
+            else:
+                # Calculate relevance scores
+                scores = self._score_chunks(query)
+                
+                # Select the top k by score without sorting every match; equal
+                # scores keep document order (lower chunk index first)
+                ranked = heapq.nlargest(top_k, scores, key=lambda idx: (scores[idx], -idx))
+                
+                results = [{**self.chunks[idx], 'score': scores[idx], 'keyword_score': scores[idx]} for idx in ranked]
             
-            # Return top k
-            return scored_chunks[:top_k]
+            self._cache_put(self._retrieval_cache, (query, top_k), results)
+            return results
             
         except Exception as e:
-            print(f"❌ Error retrieving chunks: {str(e)}")
+            logger.error("❌ Error retrieving chunks: %s", e)
             return []
     
+    def _cache_get(self, cache: OrderedDict, key):
+        """Look up a result cache entry, marking it most recently used"""
+        with self._cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+    
+    def _cache_put(self, cache: OrderedDict, key, value):
+        """Store a result cache entry, evicting the least recently used beyond RESULT_CACHE_SIZE"""
+        with self._cache_lock:
+            cache[key] = value
+            while len(cache) > self.RESULT_CACHE_SIZE:
+                cache.popitem(last=False)
+    
+    def _prewarm_gemini_client(self):
+        """Open the Gemini connection early so the first query skips the handshake (best effort)"""
+        try:
+            self.gemini_client.models.get(model=self.GEMINI_MODEL)
+        except Exception as e:
+            logger.warning("⚠️ Gemini prewarm skipped: %s", e)
+    
     def _call_gemini_with_retry(self, prompt: str, max_retries: int = 3) -> Optional[str]:
         """Call Gemini API with automatic retry logic for handling temporary failures"""
         retry_delay = 1
@@ -162,7 +417,7 @@ class RAGPipeline:
         for attempt in range(max_retries):
             try:
                 response = self.gemini_client.models.generate_content(
-                    model="gemini-2.0-flash-exp",
+                    model=self.GEMINI_MODEL,
                     contents=prompt
                 )
                 break
@@ -170,9 +425,11 @@ class RAGPipeline:
                 error_str = str(e)
                 if "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
                     if attempt < max_retries - 1:
-                        print(f"⚠️ Gemini API temporarily unavailable (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
+                        # Random jitter keeps concurrent callers from retrying in lockstep
+                        delay = retry_delay + random.uniform(0, retry_delay)
+                        logger.warning("⚠️ Gemini API temporarily unavailable (attempt %s/%s), retrying in %.1fs...", attempt + 1, max_retries, delay)
+                        time.sleep(delay)
+                        retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
                         continue
                 raise
         
@@ -180,185 +437,284 @@ class RAGPipeline:
             return response.text.strip()
         return None
     
-    def generate_response(self, query: str, external_web_content: Optional[List[Dict[str, str]]] = None) -> str:
-        """Generate a response using RAG pipeline with optional web content and extended knowledge fallback"""
-        try:
-            print(f"🤔 Processing query: {query[:100]}...")
-            
-            # Retrieve relevant chunks from Drive documents
-            relevant_chunks = self._retrieve_relevant_chunks(query, top_k=5)
-            
-            # Define thresholds
-            URL_DETECTION_THRESHOLD = 0.2  # Lower threshold for URL detection
-            RELEVANCE_THRESHOLD = 0.4  # Stricter threshold for answer synthesis
-            
-            # Extract URLs from ALL relevant chunks (using lower threshold)
-            # This ensures we find URLs even if the chunk isn't highly relevant by keywords
-            drive_web_content = []
-            url_candidate_chunks = [
-                chunk for chunk in relevant_chunks
-                if chunk['score'] > URL_DETECTION_THRESHOLD
-            ]
-            
-            if url_candidate_chunks:
-                print("🔍 Scanning Drive documents for URLs...")
-                # Combine text from all candidate chunks to search for URLs
-                drive_text = " ".join([chunk['content'] for chunk in url_candidate_chunks])
-                drive_urls = WebContentService.detect_urls(drive_text)
-                
-                if drive_urls:
-                    print(f"🔗 Found {len(drive_urls)} URL(s) in Drive documents")
-                    drive_web_content = WebContentService.fetch_all_urls(drive_urls)
-                    if drive_web_content:
-                        print(f"✅ Fetched content from {len(drive_web_content)} Drive-mentioned URL(s)")
-            
-            # Filter chunks by stricter relevance threshold for answer synthesis
-            filtered_chunks = [
-                chunk for chunk in relevant_chunks
-                if chunk['score'] > RELEVANCE_THRESHOLD
-            ]
-            
-            # Check if we have high-quality Drive information
-            # Require at least one chunk with good relevance score
-            has_drive_info = len(filtered_chunks) > 0 and filtered_chunks[0]['score'] > 0.4
-            has_web_info = external_web_content is not None and len(external_web_content) > 0
-            has_drive_web_info = len(drive_web_content) > 0
-            
-            if has_drive_info or has_web_info or has_drive_web_info:
-                # Use Drive documents and/or web content to answer
-                if has_drive_info:
-                    print(f"📄 Found {len(filtered_chunks)} relevant chunks in Drive documents")
-                if has_web_info:
-                    print(f"🔗 Found {len(external_web_content)} web sources from user query")
-                if has_drive_web_info:
-                    print(f"🔗 Found {len(drive_web_content)} web sources from Drive documents")
-                
-                # Prepare context from relevant chunks
-                context_parts = []
-                drive_sources = set()
-                web_sources_user = []
-                web_sources_drive = []
-                
-                # Add Drive context
-                if has_drive_info:
-                    context_parts.append("=== Information from Google Drive Documents ===")
-                    for chunk in filtered_chunks[:3]:  # Use top 3 chunks
-                        context_parts.append(chunk['content'])
-                        drive_sources.add(chunk['document_name'])
-                
-                # Add web content from Drive-mentioned URLs
-                if has_drive_web_info:
-                    context_parts.append("\n=== Information from URLs mentioned in Drive Documents ===")
-                    for web_item in drive_web_content:
-                        context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
-                        web_sources_drive.append(web_item['url'])
-                
-                # Add web content from user query
-                if has_web_info:
-                    context_parts.append("\n=== Information from URLs in Your Question ===")
-                    for web_item in external_web_content:
-                        context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
-                        web_sources_user.append(web_item['url'])
-                
-                context = "\n\n".join(context_parts)
-                
-                # Create prompt for Gemini with combined context
-                source_count = sum([has_drive_info, has_web_info, has_drive_web_info])
-                if source_count > 1:
-                    instruction = "Based on the following context from multiple sources (Google Drive documents and web links), please answer the user's question. Synthesize information from all sources where relevant."
-                elif has_drive_info:
-                    instruction = "Based on the following context from Google Drive documents, please answer the user's question."
-                else:
-                    instruction = "Based on the following context from web links, please answer the user's question."
-                
-                prompt = f"""{instruction}
-
-{context}
-
-User question: {query}
-
-Please provide a helpful and accurate answer based on the information provided. If you use specific information from the context, be precise and factual."""
-                
-                # Generate response using Gemini
-                response_text = self._call_gemini_with_retry(prompt)
-                
-                if not response_text:
-                    return "Unable to generate response at this time. Please try again."
-                
-                # Check if Gemini couldn't answer from provided context
-                # If so, and extended knowledge is enabled, try general knowledge
-                no_info_phrases = ["no relevant information found", "no information found", "not enough information"]
-                if any(phrase in response_text.lower() for phrase in no_info_phrases):
-                    if self.use_extended_knowledge:
-                        print("🌐 Provided context insufficient, switching to general knowledge...")
-                        # Fall back to general knowledge
-                        gk_prompt = f"""Please answer the following question based on your general knowledge. Provide a clear, accurate, and helpful response.
+    def _stream_gemini_with_retry(self, prompt: str, max_retries: int = 3) -> Iterator[str]:
+        """Stream Gemini API output, retrying only until the first chunk arrives"""
+        retry_delay = 1
+        
+        for attempt in range(max_retries):
+            started = False
+            try:
+                for chunk in self.gemini_client.models.generate_content_stream(
+                    model=self.GEMINI_MODEL,
+                    contents=prompt
+                ):
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except Exception as e:
+                # A retry after partial output would duplicate text
+                if started:
+                    raise
+                error_str = str(e)
+                if "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
+                    if attempt < max_retries - 1:
+                        # Random jitter keeps concurrent callers from retrying in lockstep
+                        delay = retry_delay + random.uniform(0, retry_delay)
+                        logger.warning("⚠️ Gemini API temporarily unavailable (attempt %s/%s), retrying in %.1fs...", attempt + 1, max_retries, delay)
+                        time.sleep(delay)
+                        retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
+                        continue
+                raise
+    
+    @staticmethod
+    def _general_knowledge_prompt(query: str) -> str:
+        """Build the prompt used for general knowledge fallback"""
+        return f"""Please answer the following question based on your general knowledge. Provide a clear, accurate, and helpful response.
 
 User question: {query}
 
 Please provide a comprehensive answer."""
-                        
-                        gk_response = self._call_gemini_with_retry(gk_prompt)
-                        if gk_response:
-                            gk_response += "\n\n*🌐 Note: This answer is based on general knowledge, as no relevant information was found in the provided sources.*"
-                            return gk_response
-                
-                # Add source attribution
-                attribution_parts = []
-                
-                if has_drive_info:
-                    drive_source_list = ", ".join(sorted(drive_sources))
-                    if len(drive_sources) == 1:
-                        attribution_parts.append(f"📄 Drive Source: {drive_source_list}")
-                    else:
-                        attribution_parts.append(f"📄 Drive Sources: {drive_source_list}")
-                
-                if has_drive_web_info:
-                    if len(web_sources_drive) == 1:
-                        attribution_parts.append(f"🔗 Web Link (from Drive): {web_sources_drive[0]}")
-                    else:
-                        web_list = "\n  • ".join(web_sources_drive)
-                        attribution_parts.append(f"🔗 Web Links (from Drive):\n  • {web_list}")
-                
-                if has_web_info:
-                    if len(web_sources_user) == 1:
-                        attribution_parts.append(f"🔗 Web Link (from your question): {web_sources_user[0]}")
-                    else:
-                        web_list = "\n  • ".join(web_sources_user)
-                        attribution_parts.append(f"🔗 Web Links (from your question):\n  • {web_list}")
-                
-                if attribution_parts:
-                    response_text += "\n\n*" + "\n".join(attribution_parts) + "*"
-                
-                return response_text
+    
+    @staticmethod
+    def _is_no_info_response(response_text: str) -> bool:
+        """Check if Gemini couldn't answer from the provided context"""
+        # One case-insensitive scan instead of lowercasing a copy and testing each phrase
+        return NO_INFO_PATTERN.search(response_text) is not None
+    
+    def _build_prompt(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> Tuple[Optional[str], str, bool]:
+        """
+        Retrieve context and build the Gemini prompt for a query.
+        
+        Returns (prompt, suffix, from_context). The suffix is appended after the
+        LLM answer; when prompt is None the suffix is the complete response.
+        from_context is True when the prompt is grounded in Drive/web context.
+        """
+        # Retrieve relevant chunks from Drive documents
+        relevant_chunks = self._retrieve_relevant_chunks(query, top_k=5)
+        
+        # One pass splits the chunks into URL candidates (lower thresholds) and
+        # answer context (stricter). Keyword and cosine scores are on different
+        # scales, so each is compared with its own threshold.
+        drive_web_content = []
+        url_candidate_texts = []
+        filtered_chunks = []
+        for chunk in relevant_chunks:
+            keyword_score = chunk['keyword_score']
+            dense_score = chunk.get('dense_score', 0.0)
+            if keyword_score > self.KEYWORD_URL_THRESHOLD or dense_score > self.DENSE_URL_THRESHOLD:
+                url_candidate_texts.append(chunk['content'])
+                if keyword_score > self.KEYWORD_RELEVANCE_THRESHOLD or dense_score > self.DENSE_RELEVANCE_THRESHOLD:
+                    filtered_chunks.append(chunk)
+        
+        if url_candidate_texts:
+            logger.debug("🔍 Scanning Drive documents for URLs...")
+            # Combine text from all candidate chunks to search for URLs
+            drive_text = " ".join(url_candidate_texts)
+            drive_urls = WebContentService.detect_urls(drive_text)
+            
+            if drive_urls:
+                logger.debug("🔗 Found %s URL(s) in Drive documents", len(drive_urls))
+                drive_web_content = WebContentService.fetch_all_urls(drive_urls)
+                if drive_web_content:
+                    logger.debug("✅ Fetched content from %s Drive-mentioned URL(s)", len(drive_web_content))
+        
+        # Await web content fetched concurrently by the caller, if any
+        if isinstance(external_web_content, Future):
+            external_web_content = external_web_content.result()
+        
+        # Check if we have high-quality Drive information
+        # (every filtered chunk already cleared a relevance threshold)
+        has_drive_info = len(filtered_chunks) > 0
+        has_web_info = external_web_content is not None and len(external_web_content) > 0
+        has_drive_web_info = len(drive_web_content) > 0
+        
+        if has_drive_info or has_web_info or has_drive_web_info:
+            # Use Drive documents and/or web content to answer
+            if has_drive_info:
+                logger.debug("📄 Found %s relevant chunks in Drive documents", len(filtered_chunks))
+            if has_web_info:
+                logger.debug("🔗 Found %s web sources from user query", len(external_web_content))
+            if has_drive_web_info:
+                logger.debug("🔗 Found %s web sources from Drive documents", len(drive_web_content))
+            
+            # Prepare context from relevant chunks
+            context_parts = []
+            drive_sources = set()
+            web_sources_user = []
+            web_sources_drive = []
+            
+            # Add Drive context
+            if has_drive_info:
+                context_parts.append("=== Information from Google Drive Documents ===")
+                for chunk in filtered_chunks[:3]:  # Use top 3 chunks
+                    context_parts.append(chunk['content'])
+                    drive_sources.add(chunk['document_name'])
+            
+            # Add web content from Drive-mentioned URLs
+            if has_drive_web_info:
+                context_parts.append("\n=== Information from URLs mentioned in Drive Documents ===")
+                for web_item in drive_web_content:
+                    context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
+                    web_sources_drive.append(web_item['url'])
+            
+            # Add web content from user query
+            if has_web_info:
+                context_parts.append("\n=== Information from URLs in Your Question ===")
+                for web_item in external_web_content:
+                    context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
+                    web_sources_user.append(web_item['url'])
             
+            context = "\n\n".join(context_parts)
+            
+            # Create prompt for Gemini with combined context
+            source_count = sum([has_drive_info, has_web_info, has_drive_web_info])
+            if source_count > 1:
+                instruction = "Based on the following context from multiple sources (Google Drive documents and web links), please answer the user's question. Synthesize information from all sources where relevant."
+            elif has_drive_info:
+                instruction = "Based on the following context from Google Drive documents, please answer the user's question."
             else:
-                # No relevant info found in Drive
-                if self.use_extended_knowledge:
-                    # Fall back to general knowledge
-                    print("🌐 No relevant information in Drive. Using general knowledge...")
-                    
-                    # Create prompt for general knowledge query
-                    prompt = f"""Please answer the following question based on your general knowledge. Provide a clear, accurate, and helpful response.
+                instruction = "Based on the following context from web links, please answer the user's question."
+            
+            prompt = f"""{instruction}
+
+{context}
 
 User question: {query}
 
-Please provide a comprehensive answer."""
-                    
-                    # Generate response using Gemini's general knowledge
-                    response_text = self._call_gemini_with_retry(prompt)
-                    
-                    if not response_text:
-                        return "Unable to generate response at this time. Please try again."
-                    
-                    # Add attribution indicating general knowledge was used
-                    response_text += "\n\n*🌐 Note: This answer is based on general knowledge, as no relevant information was found in your Google Drive documents.*"
-                    
-                    return response_text
+Please provide a helpful and accurate answer based on the information provided. If you use specific information from the context, be precise and factual."""
+            
+            # Add source attribution
+            attribution_parts = []
+            
+            if has_drive_info:
+                drive_source_list = ", ".join(sorted(drive_sources))
+                if len(drive_sources) == 1:
+                    attribution_parts.append(f"📄 Drive Source: {drive_source_list}")
+                else:
+                    attribution_parts.append(f"📄 Drive Sources: {drive_source_list}")
+            
+            if has_drive_web_info:
+                if len(web_sources_drive) == 1:
+                    attribution_parts.append(f"🔗 Web Link (from Drive): {web_sources_drive[0]}")
+                else:
+                    web_list = "\n  • ".join(web_sources_drive)
+                    attribution_parts.append(f"🔗 Web Links (from Drive):\n  • {web_list}")
+            
+            if has_web_info:
+                if len(web_sources_user) == 1:
+                    attribution_parts.append(f"🔗 Web Link (from your question): {web_sources_user[0]}")
                 else:
-                    # Extended knowledge disabled - return not found message
-                    return "No relevant information found in your Google Drive documents."
+                    web_list = "\n  • ".join(web_sources_user)
+                    attribution_parts.append(f"🔗 Web Links (from your question):\n  • {web_list}")
+            
+            suffix = ""
+            if attribution_parts:
+                suffix = "\n\n*" + "\n".join(attribution_parts) + "*"
+            
+            return prompt, suffix, True
+        
+        # No relevant info found in Drive
+        if self.use_extended_knowledge:
+            # Fall back to general knowledge
+            logger.debug("🌐 No relevant information in Drive. Using general knowledge...")
+            suffix = "\n\n*🌐 Note: This answer is based on general knowledge, as no relevant information was found in your Google Drive documents.*"
+            return self._general_knowledge_prompt(query), suffix, False
+        
+        # Extended knowledge disabled - return not found message
+        return None, "No relevant information found in your Google Drive documents.", False
+    
+    def generate_response(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> str:
+        """
+        Generate a response using RAG pipeline with optional web content and extended knowledge fallback
+        
+        Answers to queries without attached web content are cached until the
+        documents are reloaded; failed generations are not cached.
+        """
+        cacheable = external_web_content is None
+        if cacheable:
+            cached = self._cache_get(self._response_cache, query)
+            if cached is not None:
+                return cached
+        
+        try:
+            logger.debug("🤔 Processing query: %.100s...", query)
+            
+            prompt, suffix, from_context = self._build_prompt(query, external_web_content)
+            if prompt is None:
+                return suffix
+            
+            # Speculatively start the general-knowledge answer; it is only
+            # used if the context answer turns out to have no information
+            gk_future = None
+            if from_context and self.use_extended_knowledge and self._fallback_executor:
+                gk_future = self._fallback_executor.submit(
+                    self._call_gemini_with_retry, self._general_knowledge_prompt(query)
+                )
+            
+            # Generate response using Gemini
+            response_text = self._call_gemini_with_retry(prompt)
+            
+            if not response_text:
+                return "Unable to generate response at this time. Please try again."
+            
+            # Check if Gemini couldn't answer from provided context
+            # If so, and extended knowledge is enabled, try general knowledge
+            if from_context and self._is_no_info_response(response_text):
+                if self.use_extended_knowledge:
+                    logger.debug("🌐 Provided context insufficient, switching to general knowledge...")
+                    if gk_future is not None:
+                        gk_response = gk_future.result()
+                    else:
+                        gk_response = self._call_gemini_with_retry(self._general_knowledge_prompt(query))
+                    if gk_response:
+                        gk_response += "\n\n*🌐 Note: This answer is based on general knowledge, as no relevant information was found in the provided sources.*"
+                        if cacheable:
+                            self._cache_put(self._response_cache, query, gk_response)
+                        return gk_response
+            
+            response = response_text + suffix
+            if cacheable:
+                self._cache_put(self._response_cache, query, response)
+            return response
             
         except Exception as e:
-            print(f"❌ Error generating response: {str(e)}")
+            logger.error("❌ Error generating response: %s", e)
             return f"Error generating response: {str(e)}"
+    
+    def generate_response_stream(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> Iterator[str]:
+        """
+        Streaming variant of generate_response that yields partial strings.
+        
+        Since the no-information check needs the full context answer, a general
+        knowledge fallback is streamed after it rather than replacing it.
+        """
+        try:
+            logger.debug("🤔 Processing query (streaming): %.100s...", query)
+            
+            prompt, suffix, from_context = self._build_prompt(query, external_web_content)
+            if prompt is None:
+                yield suffix
+                return
+            
+            response_parts = []
+            for text in self._stream_gemini_with_retry(prompt):
+                response_parts.append(text)
+                yield text
+            
+            if not response_parts:
+                yield "Unable to generate response at this time. Please try again."
+                return
+            
+            if from_context and self.use_extended_knowledge and self._is_no_info_response("".join(response_parts)):
+                logger.debug("🌐 Provided context insufficient, switching to general knowledge...")
+                yield "\n\n"
+                yield from self._stream_gemini_with_retry(self._general_knowledge_prompt(query))
+                yield "\n\n*🌐 Note: This answer is based on general knowledge, as no relevant information was found in the provided sources.*"
+                return
+            
+            yield suffix
+            
+        except Exception as e:
+            logger.error("❌ Error generating response: %s", e)
+            yield f"Error generating response: {str(e)}"
@@ -3,21 +3,83 @@ RAG Pipeline for querying PostgreSQL + pgvector (read-only mode for Streamlit ap
 This version queries pre-generated embeddings from Supabase instead of generating them on startup.
 """
 
-import os
-import re
 import time
-from typing import List, Dict, Optional, Any
+import hashlib
+import random
+import queue
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Dict, Optional, Any, Iterator, Tuple, Union
 from google import genai  # type: ignore
 from google.genai import types  # type: ignore
+from config import get_env
 from web_content_service import WebContentService
-from postgres_embedding_store import PostgresEmbeddingStore, compute_text_hash
+from postgres_embedding_store import PostgresEmbeddingStore, EMBEDDING_DIMENSION
+
+logger = logging.getLogger(__name__)
 
 try:
+    import torch
     from sentence_transformers import SentenceTransformer  # type: ignore
     EMBEDDING_MODEL_AVAILABLE = True
 except ImportError:
     EMBEDDING_MODEL_AVAILABLE = False
-    print("⚠️ sentence-transformers not available (only needed for embedding generation)")
+    logger.warning("⚠️ sentence-transformers not available (only needed for embedding generation)")
+
+
+class _BatchingEncoder:
+    """
+    Funnels concurrent encode() calls from chat sessions through one worker thread.
+    
+    The worker takes the oldest waiting request plus any others already
+    queued (up to MAX_BATCH texts) and encodes them in one forward pass.
+    It never waits for more requests to arrive, so a lone query is encoded
+    immediately; batching only kicks in under contention.
+    """
+    
+    MAX_BATCH = 32
+    
+    def __init__(self, model):
+        self.model = model
+        self._requests = queue.SimpleQueue()
+        threading.Thread(target=self._run, name="query-encoder", daemon=True).start()
+    
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, sharing a forward pass with concurrent callers"""
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+    
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            while size < self.MAX_BATCH:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            
+            try:
+                # encode() length-sorts the texts internally to minimize padding
+                embeddings = self.model.encode(
+                    [text for texts, _ in batch for text in texts],
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                ).tolist()
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            start = 0
+            for texts, future in batch:
+                future.set_result(embeddings[start:start + len(texts)])
+                start += len(texts)
 
 
 class RAGPipelinePostgres:
@@ -26,6 +88,13 @@ class RAGPipelinePostgres:
     Designed for Streamlit app - no embedding generation on startup, instant loading.
     """
     
+    GEMINI_MODEL = "gemini-2.0-flash-exp"
+    GEMINI_TIMEOUT_MS = 30_000  # Per-request HTTP timeout for Gemini calls
+    MAX_RETRY_DELAY = 16  # Seconds; cap for the exponential retry backoff
+    QUERY_CACHE_SIZE = 1024  # Query embeddings kept in memory
+    RESPONSE_CACHE_SIZE = 512  # Gemini answers kept in memory
+    RESPONSE_CACHE_TTL = 600  # Seconds before a cached answer is regenerated
+    
     def __init__(self, gemini_api_key: str, use_extended_knowledge: bool = True):
         """
         Initialize RAG pipeline in query-only mode.
@@ -37,8 +106,15 @@ class RAGPipelinePostgres:
         self.gemini_api_key = gemini_api_key
         self.gemini_client: Optional[genai.Client] = None
         self.embedding_model: Optional[Any] = None
+        self._encoder: Optional[_BatchingEncoder] = None
         self.embedding_store: Optional[PostgresEmbeddingStore] = None
         self.use_extended_knowledge = use_extended_knowledge
+        # Normalized query -> embedding, least recently used first; shared by all sessions
+        self._query_cache: OrderedDict = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        # Prompt digest -> (stored_at, answer text), least recently used first
+        self._response_cache: OrderedDict = OrderedDict()
+        self._response_cache_lock = threading.Lock()
         
         self._initialize_services()
     
@@ -46,65 +122,123 @@ class RAGPipelinePostgres:
         """Initialize Gemini AI client and PostgreSQL connection"""
         try:
             # Initialize Gemini client (for LLM generation only)
-            self.gemini_client = genai.Client(api_key=self.gemini_api_key)
-            print("✅ Gemini AI client initialized (for LLM generation)")
+            self.gemini_client = genai.Client(
+                api_key=self.gemini_api_key,
+                http_options=types.HttpOptions(timeout=self.GEMINI_TIMEOUT_MS)
+            )
+            logger.info("✅ Gemini AI client initialized (for LLM generation)")
+            self._prewarm_gemini_client()
             
             # Initialize PostgreSQL embedding store
             self.embedding_store = PostgresEmbeddingStore()
-            print("✅ Connected to PostgreSQL database with pgvector")
+            logger.info("✅ Connected to PostgreSQL database with pgvector")
             
             # Initialize embedding model for query encoding only
             if EMBEDDING_MODEL_AVAILABLE:
-                print("🔄 Loading embedding model for query encoding...")
-                self.embedding_model = SentenceTransformer(
-                    'sentence-transformers/all-MiniLM-L6-v2',
-                    device='cpu'
-                )
-                print("✅ Embedding model loaded (768-dim, for queries only)")
+                logger.info("🔄 Loading embedding model for query encoding...")
+                self.embedding_model = self._load_embedding_model()
+                dimension = self.embedding_model.get_sentence_embedding_dimension()
+                if dimension != EMBEDDING_DIMENSION:
+                    raise ValueError(
+                        f"Query encoder produces {dimension}-dim embeddings, "
+                        f"but the database stores {EMBEDDING_DIMENSION}-dim vectors")
+                self._encoder = _BatchingEncoder(self.embedding_model)
+                logger.info("✅ Embedding model loaded (%s-dim, for queries only)", dimension)
             else:
-                print("⚠️ sentence-transformers not available")
+                logger.warning("⚠️ sentence-transformers not available")
                 self.embedding_model = None
             
         except Exception as e:
-            print(f"❌ Error initializing RAG pipeline: {str(e)}")
+            logger.error("❌ Error initializing RAG pipeline: %s", e)
             raise
     
+    def _load_embedding_model(self) -> Any:
+        """
+        Load the query encoder, optionally as an int8-quantized ONNX export.
+        
+        Uses the same EMBEDDING_ONNX_FILE setting as embed_pipeline (e.g.
+        onnx/model_qint8_avx2.onnx), so queries and stored chunks can be
+        encoded by the same model variant. ONNX Runtime's int8 kernels are
+        typically 2-4x faster on CPU; falls back to PyTorch FP32 if the file
+        or the sentence-transformers[onnx] extra is missing. On a CUDA
+        machine the PyTorch model runs on the GPU in FP16 instead.
+        """
+        if torch.cuda.is_available():
+            model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2', device='cuda')
+            model.half()  # FP16 roughly doubles GPU throughput; .tolist() still yields plain floats
+            logger.info("⚡ Encoding queries on CUDA (FP16)")
+            return model
+        
+        onnx_file = get_env("EMBEDDING_ONNX_FILE")
+        if onnx_file:
+            try:
+                model = SentenceTransformer(
+                    'sentence-transformers/all-MiniLM-L6-v2',
+                    device='cpu',
+                    backend='onnx',
+                    model_kwargs={'file_name': onnx_file}
+                )
+                logger.info("⚡ Using ONNX Runtime backend for queries (%s)", onnx_file)
+                return model
+            except Exception as e:
+                logger.warning("⚠️ Could not load ONNX model %s, falling back to PyTorch: %s", onnx_file, e)
+        
+        return SentenceTransformer(
+            'sentence-transformers/all-MiniLM-L6-v2',
+            device='cpu'
+        )
+    
     def initialize_with_documents(self, documents: List[Dict[str, str]]):
         """
         NO-OP for query-only mode.
         Documents are already embedded and stored in PostgreSQL by the pipeline.
         This method exists for API compatibility with the old implementation.
         """
-        print("ℹ️  Query-only mode: Using pre-generated embeddings from PostgreSQL")
+        logger.info("ℹ️  Query-only mode: Using pre-generated embeddings from PostgreSQL")
         
         # Show database stats
         if self.embedding_store:
             stats = self.embedding_store.get_stats()
-            print(f"📊 Database contains {stats.get('total_chunks', 0)} chunks from {stats.get('total_documents', 0)} documents")
+            logger.info("📊 Database contains %s chunks from %s documents", stats.get('total_chunks', 0), stats.get('total_documents', 0))
+    
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """Cache key for a query: the model is uncased and splits on whitespace, so neither changes its embedding"""
+        return " ".join(query.lower().split())
     
     def _generate_query_embedding(self, query: str) -> List[float]:
         """
         Generate embedding for a query (not for documents).
         
+        Embeddings of recently seen queries come from an in-memory LRU cache.
+        
         Args:
             query: User query text
             
         Returns:
-            768-dimensional embedding vector
+            EMBEDDING_DIMENSION-dimensional embedding vector
         """
         if not self.embedding_model:
             raise ValueError("Embedding model not initialized")
         
+        key = self._normalize_query(query)
+        with self._query_cache_lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+        
         try:
-            embedding = self.embedding_model.encode(
-                [query],
-                convert_to_numpy=True,
-                show_progress_bar=False
-            )
-            return embedding[0].tolist()
+            embedding = self._encoder.encode([key])[0]
         except Exception as e:
-            print(f"❌ Error generating query embedding: {str(e)}")
+            logger.error("❌ Error generating query embedding: %s", e)
             raise
+        
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        
+        return embedding
     
     def _retrieve_relevant_chunks(self, query: str, top_k: int = 5) -> List[Dict]:
         """
@@ -140,18 +274,32 @@ class RAGPipelinePostgres:
                     'document_id': result['document_id'],
                     'content': result['content'],
                     'score': result['score'],
-                    'document_name': metadata.get('document_name', 'Unknown')
+                    'document_name': metadata.get('document_name', 'Unknown'),
+                    'urls': metadata.get('urls')
                 })
             
-            print(f"🔍 Found {len(relevant_chunks)} relevant chunks using pgvector")
+            logger.debug("🔍 Found %s relevant chunks using pgvector", len(relevant_chunks))
             return relevant_chunks
             
         except Exception as e:
-            print(f"❌ Error retrieving chunks: {str(e)}")
+            logger.error("❌ Error retrieving chunks: %s", e)
             import traceback
             traceback.print_exc()
             return []
     
+    def _prewarm_gemini_client(self):
+        """
+        Open the Gemini HTTPS connection up front with a cheap metadata call.
+        
+        The pipeline is built once under st.cache_resource, so the TLS handshake
+        is paid here instead of on the first user question. Failures are
+        non-fatal - the first real request will simply connect on its own.
+        """
+        try:
+            self.gemini_client.models.get(model=self.GEMINI_MODEL)
+        except Exception as e:
+            logger.warning("⚠️ Gemini prewarm skipped: %s", e)
+    
     def _call_gemini_with_retry(self, prompt: str, max_retries: int = 3) -> Optional[str]:
         """Call Gemini API with automatic retry logic"""
         if not self.gemini_client:
@@ -163,7 +311,7 @@ class RAGPipelinePostgres:
         for attempt in range(max_retries):
             try:
                 response = self.gemini_client.models.generate_content(
-                    model="gemini-2.0-flash-exp",
+                    model=self.GEMINI_MODEL,
                     contents=prompt
                 )
                 break
@@ -172,15 +320,17 @@ class RAGPipelinePostgres:
                 
                 # Check for quota exhaustion
                 if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str or "Quota exceeded" in error_str:
-                    print(f"⚠️ Gemini API quota exceeded. Please wait or use a different API key.")
+                    logger.warning("⚠️ Gemini API quota exceeded. Please wait or use a different API key.")
                     raise ValueError("Gemini API quota exceeded. The free tier has daily limits. Please try again later or use an API key with higher quota.")
                 
                 # Check for temporary unavailability
                 if "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
                     if attempt < max_retries - 1:
-                        print(f"⚠️ Gemini API temporarily unavailable (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
+                        # Random jitter keeps concurrent callers from retrying in lockstep
+                        delay = retry_delay + random.uniform(0, retry_delay)
+                        logger.warning("⚠️ Gemini API temporarily unavailable (attempt %s/%s), retrying in %.1fs...", attempt + 1, max_retries, delay)
+                        time.sleep(delay)
+                        retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
                         continue
                 raise
         
@@ -188,152 +338,301 @@ class RAGPipelinePostgres:
             return response.text.strip()
         return None
     
-    def generate_response(self, query: str, external_web_content: Optional[List[Dict[str, str]]] = None) -> str:
+    @staticmethod
+    def _response_cache_key(prompt: str) -> bytes:
+        """Digest of a prompt; the prompt embeds the query and retrieved context"""
+        return hashlib.blake2b(prompt.encode('utf-8'), digest_size=16).digest()
+    
+    def _get_cached_response(self, key: bytes) -> Optional[str]:
+        """Return a cached Gemini answer that is still within RESPONSE_CACHE_TTL"""
+        with self._response_cache_lock:
+            entry = self._response_cache.get(key)
+            if entry is None:
+                return None
+            stored_at, text = entry
+            if time.monotonic() - stored_at > self.RESPONSE_CACHE_TTL:
+                del self._response_cache[key]
+                return None
+            self._response_cache.move_to_end(key)
+            return text
+    
+    def _cache_response(self, key: bytes, text: str):
+        """Cache a Gemini answer, evicting the least recently used beyond RESPONSE_CACHE_SIZE"""
+        with self._response_cache_lock:
+            self._response_cache[key] = (time.monotonic(), text)
+            self._response_cache.move_to_end(key)
+            while len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+    
+    def _stream_gemini_with_retry(self, prompt: str, max_retries: int = 3) -> Iterator[str]:
         """
-        Generate a response using RAG pipeline with pgvector semantic search.
+        Stream Gemini API output, retrying only until the first chunk arrives.
+        
+        Once text has been yielded to the caller a retry would duplicate output,
+        so later failures are re-raised as-is.
+        """
+        if not self.gemini_client:
+            raise ValueError("Gemini client not initialized")
+        
+        retry_delay = 1
+        
+        for attempt in range(max_retries):
+            started = False
+            try:
+                for chunk in self.gemini_client.models.generate_content_stream(
+                    model=self.GEMINI_MODEL,
+                    contents=prompt
+                ):
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except Exception as e:
+                if started:
+                    raise
+                
+                error_str = str(e)
+                
+                # Check for quota exhaustion
+                if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str or "Quota exceeded" in error_str:
+                    logger.warning("⚠️ Gemini API quota exceeded. Please wait or use a different API key.")
+                    raise ValueError("Gemini API quota exceeded. The free tier has daily limits. Please try again later or use an API key with higher quota.")
+                
+                # Check for temporary unavailability
+                if "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
+                    if attempt < max_retries - 1:
+                        # Random jitter keeps concurrent callers from retrying in lockstep
+                        delay = retry_delay + random.uniform(0, retry_delay)
+                        logger.warning("⚠️ Gemini API temporarily unavailable (attempt %s/%s), retrying in %.1fs...", attempt + 1, max_retries, delay)
+                        time.sleep(delay)
+                        retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
+                        continue
+                raise
+    
+    def _build_prompt(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> Tuple[Optional[str], str]:
+        """
+        Retrieve context and build the Gemini prompt for a query.
         
         Args:
             query: User query
-            external_web_content: Optional web content from URLs in query
+            external_web_content: Optional web content from URLs in query, or a
+                Future resolving to it so the fetch can overlap with retrieval
             
         Returns:
-            Generated response with source attribution
+            (prompt, suffix) - suffix is appended after the LLM answer. When prompt
+            is None no LLM call is needed and suffix is the complete response.
         """
-        try:
-            print(f"🤔 Processing query: {query[:100]}...")
-            
-            # Retrieve relevant chunks using pgvector
-            relevant_chunks = self._retrieve_relevant_chunks(query, top_k=5)
-            
-            # Define thresholds
-            URL_DETECTION_THRESHOLD = 0.3
-            RELEVANCE_THRESHOLD = 0.5
-            
-            # Extract URLs from relevant chunks
-            drive_web_content = []
-            url_candidate_chunks = [
-                chunk for chunk in relevant_chunks
-                if chunk['score'] > URL_DETECTION_THRESHOLD
-            ]
-            
-            if url_candidate_chunks:
-                print("🔍 Scanning Drive documents for URLs...")
-                drive_text = " ".join([chunk['content'] for chunk in url_candidate_chunks])
-                drive_urls = WebContentService.detect_urls(drive_text)
-                
-                if drive_urls:
-                    print(f"🔗 Found {len(drive_urls)} URL(s) in Drive documents")
-                    drive_web_content = WebContentService.fetch_all_urls(drive_urls)
-                    if drive_web_content:
-                        print(f"✅ Fetched content from {len(drive_web_content)} Drive-mentioned URL(s)")
-            
-            # Filter chunks by relevance threshold
-            filtered_chunks = [
-                chunk for chunk in relevant_chunks
-                if chunk['score'] > RELEVANCE_THRESHOLD
-            ]
-            
-            # Check if we have high-quality information
-            has_drive_info = len(filtered_chunks) > 0
-            has_web_info = bool(external_web_content and len(external_web_content) > 0)
-            has_drive_web_info = len(drive_web_content) > 0
-            
-            if has_drive_info or has_web_info or has_drive_web_info:
-                # Use Drive documents and/or web content to answer
-                if has_drive_info:
-                    print(f"📄 Found {len(filtered_chunks)} semantically relevant chunks in Drive documents")
-                if has_web_info and external_web_content:
-                    print(f"🔗 Found {len(external_web_content)} web sources from user query")
-                if has_drive_web_info:
-                    print(f"🔗 Found {len(drive_web_content)} web sources from Drive documents")
-                
-                # Prepare context from relevant chunks
-                context_parts = []
-                drive_sources = set()
-                web_sources_user = []
-                web_sources_drive = []
-                
-                # Add Drive context
-                if has_drive_info:
-                    context_parts.append("=== Information from Google Drive Documents ===")
-                    for chunk in filtered_chunks[:3]:  # Use top 3 chunks
-                        context_parts.append(chunk['content'])
-                        drive_sources.add(chunk['document_name'])
-                
-                # Add web content from Drive-mentioned URLs
-                if has_drive_web_info:
-                    context_parts.append("\n=== Information from URLs mentioned in Drive Documents ===")
-                    for web_item in drive_web_content:
-                        context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
-                        web_sources_drive.append(web_item['url'])
-                
-                # Add web content from user query
-                if has_web_info and external_web_content:
-                    context_parts.append("\n=== Information from URLs in Your Question ===")
-                    for web_item in external_web_content:
-                        context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
-                        web_sources_user.append(web_item['url'])
-                
-                context = "\n\n".join(context_parts)
-                
-                # Create prompt for Gemini
-                source_count = sum([has_drive_info, has_web_info, has_drive_web_info])
-                if source_count > 1:
-                    instruction = "Based on the following context from multiple sources (Google Drive documents and web links), please answer the user's question. Synthesize information from all sources where relevant."
-                elif has_drive_info:
-                    instruction = "Based on the following context from Google Drive documents, please answer the user's question."
-                else:
-                    instruction = "Based on the following context from web links, please answer the user's question."
-                
-                prompt = f"""{instruction}
+        # Retrieve relevant chunks using pgvector
+        relevant_chunks = self._retrieve_relevant_chunks(query, top_k=5)
+        
+        # Define thresholds
+        URL_DETECTION_THRESHOLD = 0.3
+        RELEVANCE_THRESHOLD = 0.5
+        
+        # One pass collects URLs from candidate chunks and filters chunks by
+        # the stricter relevance threshold used for context
+        drive_web_content = []
+        drive_urls = []
+        filtered_chunks = []
+        for chunk in relevant_chunks:
+            score = chunk['score']
+            if score <= URL_DETECTION_THRESHOLD:
+                continue
+            chunk_urls = chunk.get('urls')
+            if chunk_urls is None:
+                # Chunk stored before URLs were extracted at ingest time
+                chunk_urls = WebContentService.find_urls(chunk['content'])
+            drive_urls.extend(chunk_urls)
+            if score > RELEVANCE_THRESHOLD:
+                filtered_chunks.append(chunk)
+        
+        drive_urls = list(dict.fromkeys(drive_urls))[:WebContentService.MAX_URLS_PER_QUERY]
+        if drive_urls:
+            logger.debug("🔗 Found %s URL(s) in Drive documents", len(drive_urls))
+            drive_web_content = WebContentService.fetch_all_urls(drive_urls)
+            if drive_web_content:
+                logger.debug("✅ Fetched content from %s Drive-mentioned URL(s)", len(drive_web_content))
+        
+        # Web content may still be downloading in the caller's thread; it is
+        # only awaited now, so the fetch overlapped with retrieval above
+        if isinstance(external_web_content, Future):
+            external_web_content = external_web_content.result()
+        
+        # Check if we have high-quality information
+        has_drive_info = len(filtered_chunks) > 0
+        has_web_info = bool(external_web_content and len(external_web_content) > 0)
+        has_drive_web_info = len(drive_web_content) > 0
+        
+        if has_drive_info or has_web_info or has_drive_web_info:
+            # Use Drive documents and/or web content to answer
+            if has_drive_info:
+                logger.debug("📄 Found %s semantically relevant chunks in Drive documents", len(filtered_chunks))
+            if has_web_info and external_web_content:
+                logger.debug("🔗 Found %s web sources from user query", len(external_web_content))
+            if has_drive_web_info:
+                logger.debug("🔗 Found %s web sources from Drive documents", len(drive_web_content))
+            
+            # Prepare context from relevant chunks
+            context_parts = []
+            drive_sources = set()
+            web_sources_user = []
+            web_sources_drive = []
+            
+            # Add Drive context
+            if has_drive_info:
+                context_parts.append("=== Information from Google Drive Documents ===")
+                for chunk in filtered_chunks[:3]:  # Use top 3 chunks
+                    context_parts.append(chunk['content'])
+                    drive_sources.add(chunk['document_name'])
+            
+            # Add web content from Drive-mentioned URLs
+            if has_drive_web_info:
+                context_parts.append("\n=== Information from URLs mentioned in Drive Documents ===")
+                for web_item in drive_web_content:
+                    context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
+                    web_sources_drive.append(web_item['url'])
+            
+            # Add web content from user query
+            if has_web_info and external_web_content:
+                context_parts.append("\n=== Information from URLs in Your Question ===")
+                for web_item in external_web_content:
+                    context_parts.append(f"URL: {web_item['url']}\nTitle: {web_item['title']}\nContent: {web_item['content']}")
+                    web_sources_user.append(web_item['url'])
+            
+            context = "\n\n".join(context_parts)
+            
+            # Create prompt for Gemini
+            source_count = sum([has_drive_info, has_web_info, has_drive_web_info])
+            if source_count > 1:
+                instruction = "Based on the following context from multiple sources (Google Drive documents and web links), please answer the user's question. Synthesize information from all sources where relevant."
+            elif has_drive_info:
+                instruction = "Based on the following context from Google Drive documents, please answer the user's question."
+            else:
+                instruction = "Based on the following context from web links, please answer the user's question."
+            
+            prompt = f"""{instruction}
 
 {context}
 
 User question: {query}
 
 Please provide a helpful and accurate answer based on the information provided. If you use specific information from the context, be precise and factual."""
-                
-                # Generate response using Gemini
-                response_text = self._call_gemini_with_retry(prompt)
-                
-                if not response_text:
-                    return "Unable to generate response at this time. Please try again."
-                
-                # Build response with sources
-                response_parts = [response_text]
-                
-                if drive_sources:
-                    response_parts.append(f"\n\n📄 **Sources:** {', '.join(sorted(drive_sources))}")
-                
-                if web_sources_drive:
-                    response_parts.append(f"\n🔗 **Related URLs from documents:** {', '.join(web_sources_drive[:3])}")
-                
-                if web_sources_user:
-                    response_parts.append(f"\n🔗 **Web sources:** {', '.join(web_sources_user)}")
-                
-                return "".join(response_parts)
             
-            else:
-                # No relevant information found - use extended knowledge if enabled
-                if self.use_extended_knowledge:
-                    print("🌐 No relevant information in Drive/web, using Gemini's general knowledge")
-                    
-                    prompt = f"""The user has asked a question, but no relevant information was found in their Google Drive documents or provided web sources.
+            # Build source attribution
+            suffix_parts = []
+            
+            if drive_sources:
+                suffix_parts.append(f"\n\n📄 **Sources:** {', '.join(sorted(drive_sources))}")
+            
+            if web_sources_drive:
+                suffix_parts.append(f"\n🔗 **Related URLs from documents:** {', '.join(web_sources_drive[:3])}")
+            
+            if web_sources_user:
+                suffix_parts.append(f"\n🔗 **Web sources:** {', '.join(web_sources_user)}")
+            
+            return prompt, "".join(suffix_parts)
+        
+        # No relevant information found - use extended knowledge if enabled
+        if self.use_extended_knowledge:
+            logger.debug("🌐 No relevant information in Drive/web, using Gemini's general knowledge")
+            
+            prompt = f"""The user has asked a question, but no relevant information was found in their Google Drive documents or provided web sources.
 
 User question: {query}
 
 Please provide a helpful answer using your general knowledge. Be clear, accurate, and concise."""
-                    
-                    response_text = self._call_gemini_with_retry(prompt)
-                    
-                    if response_text:
-                        return f"{response_text}\n\n🌐 *Note: This answer is based on general knowledge, not your Drive documents.*"
-                    else:
-                        return "Unable to generate response at this time. Please try again."
-                else:
-                    return "No relevant information found in your documents. Try rephrasing your question or check if the documents contain the information you're looking for."
+            
+            return prompt, "\n\n🌐 *Note: This answer is based on general knowledge, not your Drive documents.*"
+        
+        return None, "No relevant information found in your documents. Try rephrasing your question or check if the documents contain the information you're looking for."
+    
+    def generate_response(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> str:
+        """
+        Generate a response using RAG pipeline with pgvector semantic search.
+        
+        Args:
+            query: User query
+            external_web_content: Optional web content from URLs in query, or a
+                Future resolving to it so the fetch can overlap with retrieval
+            
+        Returns:
+            Generated response with source attribution
+        """
+        try:
+            logger.debug("🤔 Processing query: %.100s...", query)
+            
+            prompt, suffix = self._build_prompt(query, external_web_content)
+            if prompt is None:
+                return suffix
+            
+            # Identical prompts (reruns, refreshes) reuse the earlier answer.
+            # Answers built from the user's own URLs are not cached.
+            cache_key = self._response_cache_key(prompt) if external_web_content is None else None
+            response_text = self._get_cached_response(cache_key) if cache_key else None
+            if response_text is not None:
+                logger.debug("⚡ Using cached Gemini response")
+                return response_text + suffix
+            
+            # Generate response using Gemini
+            response_text = self._call_gemini_with_retry(prompt)
+            
+            if not response_text:
+                return "Unable to generate response at this time. Please try again."
+            
+            if cache_key:
+                self._cache_response(cache_key, response_text)
+            return response_text + suffix
         
         except Exception as e:
             error_msg = str(e)
-            print(f"❌ Error generating response: {error_msg}")
+            logger.error("❌ Error generating response: %s", error_msg)
             return f"Error generating response: {error_msg}"
+    
+    def generate_response_stream(self, query: str, external_web_content: Optional[Union[List[Dict[str, str]], Future]] = None) -> Iterator[str]:
+        """
+        Streaming variant of generate_response.
+        
+        Yields the answer incrementally as Gemini produces it, followed by the
+        source attribution. Errors are yielded as text, matching generate_response.
+        
+        Args:
+            query: User query
+            external_web_content: Optional web content from URLs in query, or a
+                Future resolving to it so the fetch can overlap with retrieval
+            
+        Yields:
+            Partial response strings
+        """
+        try:
+            logger.debug("🤔 Processing query (streaming): %.100s...", query)
+            
+            prompt, suffix = self._build_prompt(query, external_web_content)
+            if prompt is None:
+                yield suffix
+                return
+            
+            cache_key = self._response_cache_key(prompt) if external_web_content is None else None
+            cached = self._get_cached_response(cache_key) if cache_key else None
+            if cached is not None:
+                logger.debug("⚡ Using cached Gemini response")
+                yield cached
+                yield suffix
+                return
+            
+            parts = []
+            for text in self._stream_gemini_with_retry(prompt):
+                parts.append(text)
+                yield text
+            
+            if not parts:
+                yield "Unable to generate response at this time. Please try again."
+                return
+            
+            if cache_key:
+                self._cache_response(cache_key, "".join(parts).strip())
+            yield suffix
+        
+        except Exception as e:
+            error_msg = str(e)
+            logger.error("❌ Error generating response: %s", error_msg)
+            yield f"Error generating response: {error_msg}"
@@ -1,129 +1,184 @@
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
+import heapq
 import threading
 import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 class SessionManager:
     """Manages chat sessions with automatic timeout"""
     
+    SHARD_COUNT = 16  # Power of two so shard lookup is a bit mask
+    
     def __init__(self, timeout_minutes: int = 5):
         self.timeout_minutes = timeout_minutes
-        self.sessions: Dict[str, Dict] = {}
-        self.lock = threading.Lock()
+        self.timeout_seconds = timeout_minutes * 60
+        # Timestamps are time.monotonic() floats: cheap to compare and immune
+        # to wall-clock adjustments. get_session_info converts them for display.
+        # Sessions are sharded by id hash, each shard with its own lock, so
+        # concurrent users rarely contend on the same lock
+        self._shards: List[Dict[str, Dict]] = [{} for _ in range(self.SHARD_COUNT)]
+        self._shard_locks = [threading.Lock() for _ in range(self.SHARD_COUNT)]
+        # Min-heap of (expires_at, session_id); entries left behind by
+        # extended or cleared sessions are skipped when popped. The cleanup
+        # thread waits on _expiry_cond, which is never held while taking a
+        # shard lock.
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._expiry_cond = threading.Condition()
         
         # Start cleanup thread
         self.cleanup_thread = threading.Thread(target=self._cleanup_expired_sessions, daemon=True)
         self.cleanup_thread.start()
     
+    def _shard_of(self, session_id: str) -> Tuple[Dict[str, Dict], threading.Lock]:
+        """Return the (sessions dict, lock) pair that owns a session id"""
+        index = hash(session_id) & (self.SHARD_COUNT - 1)
+        return self._shards[index], self._shard_locks[index]
+    
     def create_session(self) -> str:
         """Create a new session and return session ID"""
         session_id = str(uuid.uuid4())
+        now = time.monotonic()
+        expires_at = now + self.timeout_seconds
         
-        with self.lock:
-            self.sessions[session_id] = {
-                'created_at': datetime.now(),
-                'last_activity': datetime.now(),
-                'expires_at': datetime.now() + timedelta(minutes=self.timeout_minutes)
+        sessions, lock = self._shard_of(session_id)
+        with lock:
+            sessions[session_id] = {
+                'created_at': now,
+                'last_activity': now,
+                'expires_at': expires_at
             }
+        self._schedule_expiry(expires_at, session_id)
         
-        print(f"✅ Created new session: {session_id}")
+        logger.info("✅ Created new session: %s", session_id)
         return session_id
     
     def is_session_active(self, session_id: str) -> bool:
         """Check if a session is active (not expired)"""
-        with self.lock:
-            if session_id not in self.sessions:
+        sessions, lock = self._shard_of(session_id)
+        with lock:
+            if session_id not in sessions:
                 return False
             
-            session = self.sessions[session_id]
-            return datetime.now() < session['expires_at']
+            session = sessions[session_id]
+            return time.monotonic() < session['expires_at']
     
     def update_activity(self, session_id: str) -> bool:
         """Update the last activity time for a session"""
-        with self.lock:
-            if session_id not in self.sessions:
+        sessions, lock = self._shard_of(session_id)
+        with lock:
+            if session_id not in sessions:
                 return False
             
             # Check if session is expired
-            if datetime.now() >= self.sessions[session_id]['expires_at']:
+            now = time.monotonic()
+            if now >= sessions[session_id]['expires_at']:
                 return False
             
             # Update activity and extend expiration
-            self.sessions[session_id]['last_activity'] = datetime.now()
-            self.sessions[session_id]['expires_at'] = datetime.now() + timedelta(minutes=self.timeout_minutes)
-            
-            return True
+            expires_at = now + self.timeout_seconds
+            sessions[session_id]['last_activity'] = now
+            sessions[session_id]['expires_at'] = expires_at
+        
+        self._schedule_expiry(expires_at, session_id)
+        return True
     
     def get_session_info(self, session_id: str) -> Optional[Dict]:
         """Get information about a session"""
-        with self.lock:
-            if session_id not in self.sessions:
+        sessions, lock = self._shard_of(session_id)
+        with lock:
+            if session_id not in sessions:
                 return None
             
-            session = self.sessions[session_id]
+            session = sessions[session_id]
             
             # Check if expired
-            if datetime.now() >= session['expires_at']:
+            now = time.monotonic()
+            if now >= session['expires_at']:
                 return None
             
+            # Map monotonic timestamps onto the wall clock for display
+            wall_now = datetime.now()
             return {
                 'session_id': session_id,
-                'created_at': session['created_at'],
-                'last_activity': session['last_activity'],
-                'expires_at': session['expires_at'],
-                'time_remaining': session['expires_at'] - datetime.now()
+                'created_at': wall_now - timedelta(seconds=now - session['created_at']),
+                'last_activity': wall_now - timedelta(seconds=now - session['last_activity']),
+                'expires_at': wall_now + timedelta(seconds=session['expires_at'] - now),
+                'time_remaining': timedelta(seconds=session['expires_at'] - now)
             }
     
     def clear_session(self, session_id: str) -> bool:
         """Manually clear a session"""
-        with self.lock:
-            if session_id in self.sessions:
-                del self.sessions[session_id]
-                print(f"🗑️ Manually cleared session: {session_id}")
+        sessions, lock = self._shard_of(session_id)
+        with lock:
+            if session_id in sessions:
+                del sessions[session_id]
+                logger.info("🗑️ Manually cleared session: %s", session_id)
                 return True
             return False
     
     def get_active_sessions(self) -> List[str]:
         """Get list of active session IDs"""
-        with self.lock:
-            active_sessions = []
-            current_time = datetime.now()
-            
-            for session_id, session in self.sessions.items():
-                if current_time < session['expires_at']:
-                    active_sessions.append(session_id)
-            
-            return active_sessions
+        active_sessions = []
+        current_time = time.monotonic()
+        
+        # One shard lock at a time keeps each critical section small
+        for sessions, lock in zip(self._shards, self._shard_locks):
+            with lock:
+                for session_id, session in sessions.items():
+                    if current_time < session['expires_at']:
+                        active_sessions.append(session_id)
+        
+        return active_sessions
+    
+    def _schedule_expiry(self, expires_at: float, session_id: str):
+        """Queue an expiry for the cleanup thread"""
+        with self._expiry_cond:
+            heapq.heappush(self._expiry_heap, (expires_at, session_id))
+            self._expiry_cond.notify()
     
     def _cleanup_expired_sessions(self):
-        """Background thread to clean up expired sessions"""
+        """Background thread that sleeps until the next session is due to expire"""
         while True:
             try:
-                time.sleep(60)  # Check every minute
-                
-                with self.lock:
-                    current_time = datetime.now()
-                    expired_sessions = []
+                with self._expiry_cond:
+                    if not self._expiry_heap:
+                        self._expiry_cond.wait()
+                        continue
                     
-                    for session_id, session in self.sessions.items():
-                        if current_time >= session['expires_at']:
-                            expired_sessions.append(session_id)
+                    wait_seconds = self._expiry_heap[0][0] - time.monotonic()
+                    if wait_seconds > 0:
+                        self._expiry_cond.wait(timeout=wait_seconds)
+                        continue
                     
-                    # Remove expired sessions
-                    for session_id in expired_sessions:
-                        del self.sessions[session_id]
-                        print(f"🕐 Auto-expired session: {session_id}")
+                    current_time = time.monotonic()
+                    due = []
+                    while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                        due.append(heapq.heappop(self._expiry_heap))
                 
+                # Remove expired sessions
+                for expires_at, session_id in due:
+                    sessions, lock = self._shard_of(session_id)
+                    with lock:
+                        session = sessions.get(session_id)
+                        if session is not None and session['expires_at'] == expires_at:
+                            del sessions[session_id]
+                            logger.info("🕐 Auto-expired session: %s", session_id)
+            
             except Exception as e:
-                print(f"❌ Error in session cleanup: {str(e)}")
+                logger.error("❌ Error in session cleanup: %s", e)
     
     def get_session_count(self) -> int:
         """Get total number of active sessions"""
-        with self.lock:
-            current_time = datetime.now()
-            active_count = sum(
-                1 for session in self.sessions.values()
-                if current_time < session['expires_at']
-            )
-            return active_count
+        current_time = time.monotonic()
+        active_count = 0
+        for sessions, lock in zip(self._shards, self._shard_locks):
+            with lock:
+                active_count += sum(
+                    1 for session in sessions.values()
+                    if current_time < session['expires_at']
+                )
+        return active_count
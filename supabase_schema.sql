@@ -9,26 +9,27 @@ CREATE EXTENSION IF NOT EXISTS vector;
 -- Drop existing tables if recreating
 DROP TABLE IF EXISTS document_embeddings CASCADE;
 DROP TABLE IF EXISTS document_metadata CASCADE;
+DROP TABLE IF EXISTS embedding_cache CASCADE;
 
 -- Table: document_metadata
 -- Tracks document-level information and fingerprints
 CREATE TABLE document_metadata (
     document_id TEXT PRIMARY KEY,
     document_name TEXT NOT NULL,
-    document_hash TEXT NOT NULL,  -- SHA-256 hash of content for change detection
+    document_hash TEXT NOT NULL,  -- 'x3-' xxh3 fingerprint for change detection (unprefixed: legacy SHA-256)
     chunk_count INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
 -- Table: document_embeddings
--- Stores text chunks with their 768-dimensional embeddings
+-- Stores text chunks with their 384-dimensional embeddings
 CREATE TABLE document_embeddings (
     id SERIAL PRIMARY KEY,
     document_id TEXT NOT NULL,
     chunk_id TEXT NOT NULL,  -- Format: {document_id}_chunk_{index}
     content TEXT NOT NULL,
-    embedding vector(768) NOT NULL,  -- 768-dim vectors from sentence-transformers
+    embedding vector(384) NOT NULL,  -- 384-dim vectors from all-MiniLM-L6-v2 (EMBEDDING_DIMENSION)
     metadata JSONB,  -- Flexible metadata storage (source, page, etc.)
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
@@ -42,13 +43,31 @@ CREATE TABLE document_embeddings (
     CONSTRAINT unique_chunk UNIQUE (chunk_id)
 );
 
+-- Table: embedding_cache
+-- Standalone text -> embedding cache (PostgresEmbeddingStore.get/upsert), kept
+-- out of document_embeddings so retrieval never scans cache rows. Keys include
+-- the model name and config version (compute_cache_key), so a model or
+-- chunking change invalidates old entries by making them unreachable.
+-- UNLOGGED: no WAL writes; the table is emptied after a crash, which for a
+-- cache only costs recomputation.
+CREATE UNLOGGED TABLE embedding_cache (
+    cache_key TEXT PRIMARY KEY,
+    embedding vector(384) NOT NULL,
+    metadata JSONB,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
 -- Indexes for performance
 CREATE INDEX idx_embeddings_document_id ON document_embeddings(document_id);
 CREATE INDEX idx_embeddings_chunk_id ON document_embeddings(chunk_id);
+CREATE INDEX idx_embeddings_text_hash ON document_embeddings ((metadata->>'text_hash'));
 
 -- Vector similarity search index (HNSW for fast approximate nearest neighbor)
+-- Built over a half-precision (halfvec, pgvector 0.7+) copy of each embedding:
+-- half the index size and memory traffic per traversal, while the table keeps
+-- full-precision vectors. Queries must order by the same halfvec expression.
 CREATE INDEX idx_embeddings_vector ON document_embeddings 
-    USING hnsw (embedding vector_cosine_ops)
+    USING hnsw ((embedding::halfvec(384)) halfvec_cosine_ops)
     WITH (m = 16, ef_construction = 64);
 
 -- Index on document metadata
@@ -58,7 +77,7 @@ CREATE INDEX idx_metadata_updated_at ON document_metadata(updated_at);
 -- Function: cosine_similarity_search
 -- Helper function for semantic search queries
 CREATE OR REPLACE FUNCTION cosine_similarity_search(
-    query_embedding vector(768),
+    query_embedding vector(384),
     match_threshold float DEFAULT 0.3,
     match_count int DEFAULT 5
 )
@@ -72,17 +91,21 @@ RETURNS TABLE (
 LANGUAGE plpgsql
 AS $$
 BEGIN
+    -- Top-k by index scan first, then the threshold over those k rows
+    -- (same result as filtering first, since similarity falls with distance)
     RETURN QUERY
-    SELECT 
-        e.chunk_id,
-        e.document_id,
-        e.content,
-        1 - (e.embedding <=> query_embedding) as similarity,
-        e.metadata
-    FROM document_embeddings e
-    WHERE 1 - (e.embedding <=> query_embedding) > match_threshold
-    ORDER BY e.embedding <=> query_embedding
-    LIMIT match_count;
+    SELECT top.* FROM (
+        SELECT 
+            e.chunk_id,
+            e.document_id,
+            e.content,
+            1 - (e.embedding::halfvec(384) <=> query_embedding::halfvec(384)) as similarity,
+            e.metadata
+        FROM document_embeddings e
+        ORDER BY e.embedding::halfvec(384) <=> query_embedding::halfvec(384)
+        LIMIT match_count
+    ) top
+    WHERE top.similarity > match_threshold;
 END;
 $$;
 
@@ -112,6 +135,7 @@ CREATE TRIGGER update_document_embeddings_timestamp
 -- For anon/authenticated: read-only access
 ALTER TABLE document_metadata ENABLE ROW LEVEL SECURITY;
 ALTER TABLE document_embeddings ENABLE ROW LEVEL SECURITY;
+ALTER TABLE embedding_cache ENABLE ROW LEVEL SECURITY;
 
 -- Policy: Allow service role full access
 CREATE POLICY "Service role has full access to metadata"
@@ -128,6 +152,13 @@ CREATE POLICY "Service role has full access to embeddings"
     USING (true)
     WITH CHECK (true);
 
+CREATE POLICY "Service role has full access to embedding cache"
+    ON embedding_cache
+    FOR ALL
+    TO service_role
+    USING (true)
+    WITH CHECK (true);
+
 -- Policy: Allow public read-only access for chatbot queries
 CREATE POLICY "Public read access to metadata"
     ON document_metadata
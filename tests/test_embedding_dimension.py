@@ -0,0 +1,32 @@
+"""The vector dimension baked into the SQL must match the embedding model."""
+
+import re
+from pathlib import Path
+
+import pytest
+
+store = pytest.importorskip("postgres_embedding_store")
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "supabase_schema.sql"
+VECTOR_TYPE = re.compile(r"\b(?:halfvec|vector)\((\d+)\)")
+
+
+def _dimensions(sql: str):
+    return {int(size) for size in VECTOR_TYPE.findall(sql)}
+
+
+def test_prepared_statements_use_embedding_dimension():
+    for name, (_, sql) in store.PostgresEmbeddingStore.PREPARED_STATEMENTS.items():
+        assert _dimensions(sql) <= {store.EMBEDDING_DIMENSION}, name
+
+
+def test_schema_uses_embedding_dimension():
+    dimensions = _dimensions(SCHEMA_PATH.read_text())
+    assert dimensions == {store.EMBEDDING_DIMENSION}
+
+
+def test_model_produces_embedding_dimension():
+    sentence_transformers = pytest.importorskip("sentence_transformers")
+    embed_pipeline = pytest.importorskip("embed_pipeline")
+    model = sentence_transformers.SentenceTransformer(embed_pipeline.EMBEDDING_MODEL_NAME, device='cpu')
+    assert model.get_sentence_embedding_dimension() == store.EMBEDDING_DIMENSION
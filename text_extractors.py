@@ -3,60 +3,109 @@ Text extraction utilities for different file types (PDF, JPG, etc.)
 """
 
 import io
-from typing import Optional
+import os
+import logging
+from typing import List, Optional, Union, BinaryIO
 from pypdf import PdfReader
 from PIL import Image
 import pytesseract
+from charset_normalizer import from_bytes
+
+try:
+    import pypdfium2 as pdfium
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    PDFIUM_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
 
 
 class TextExtractor:
     """Handles text extraction from various file formats"""
     
     @staticmethod
-    def extract_from_pdf(file_content: bytes) -> Optional[str]:
+    def _as_file(file_content: Union[bytes, BinaryIO]) -> BinaryIO:
+        """Wrap raw bytes in a file-like object; pass file objects through"""
+        if isinstance(file_content, (bytes, bytearray)):
+            return io.BytesIO(file_content)
+        file_content.seek(0)
+        return file_content
+    
+    @staticmethod
+    def extract_from_pdf(file_content: Union[bytes, BinaryIO]) -> Optional[str]:
         """
         Extract text from PDF file content
         
         Args:
-            file_content: Raw bytes of the PDF file
+            file_content: Raw bytes or binary file object of the PDF file
             
         Returns:
             Extracted text or None if extraction fails
         """
         try:
-            # Create a file-like object from bytes
-            pdf_file = io.BytesIO(file_content)
+            pdf_file = TextExtractor._as_file(file_content)
             
-            # Read PDF
-            reader = PdfReader(pdf_file)
+            # PDFium (C++) extracts text several times faster than pypdf's
+            # pure-Python parser; pypdf remains the fallback
+            text_parts = None
+            if PDFIUM_AVAILABLE:
+                try:
+                    text_parts = TextExtractor._extract_pdf_pages_pdfium(pdf_file)
+                except Exception as e:
+                    logger.warning("⚠️ PDFium could not read PDF, retrying with pypdf: %s", e)
+                    pdf_file.seek(0)
             
-            # Extract text from all pages
-            text_parts = []
-            for page_num, page in enumerate(reader.pages):
-                page_text = page.extract_text()
-                if page_text:
-                    text_parts.append(f"[Page {page_num + 1}]\n{page_text}")
+            if text_parts is None:
+                # Read PDF
+                reader = PdfReader(pdf_file)
+                
+                # Extract text from all pages
+                text_parts = []
+                for page_num, page in enumerate(reader.pages):
+                    page_text = page.extract_text()
+                    if page_text:
+                        text_parts.append(f"[Page {page_num + 1}]\n{page_text}")
             
             # Combine all pages
             full_text = "\n\n".join(text_parts)
             
             if not full_text.strip():
-                print("⚠️ PDF appears to be empty or image-based (might need OCR)")
+                logger.warning("⚠️ PDF appears to be empty or image-based (might need OCR)")
                 return None
             
             return full_text
             
         except Exception as e:
-            print(f"❌ Error extracting text from PDF: {str(e)}")
+            logger.error("❌ Error extracting text from PDF: %s", e)
             return None
     
     @staticmethod
-    def extract_from_image(file_content: bytes) -> Optional[str]:
+    def _extract_pdf_pages_pdfium(pdf_file: BinaryIO) -> List[str]:
+        """Extract "[Page N]" text blocks with PDFium, releasing each page as soon as it is read"""
+        pdf = pdfium.PdfDocument(pdf_file)
+        try:
+            text_parts = []
+            for page_num in range(len(pdf)):
+                page = pdf[page_num]
+                textpage = page.get_textpage()
+                try:
+                    page_text = textpage.get_text_range().replace('\r\n', '\n')
+                finally:
+                    textpage.close()
+                    page.close()
+                if page_text.strip():
+                    text_parts.append(f"[Page {page_num + 1}]\n{page_text}")
+            return text_parts
+        finally:
+            pdf.close()
+    
+    @staticmethod
+    def extract_from_image(file_content: Union[bytes, BinaryIO]) -> Optional[str]:
         """
         Extract text from image file (JPG, JPEG, PNG) using OCR
         
         Args:
-            file_content: Raw bytes of the image file
+            file_content: Raw bytes or binary file object of the image file
             
         Returns:
             Extracted text or None if extraction fails
@@ -65,46 +114,36 @@ class TextExtractor:
         try:
             # Validate file size (skip extremely large files that might cause issues)
             MAX_IMAGE_SIZE = 20 * 1024 * 1024  # 20MB
-            if len(file_content) > MAX_IMAGE_SIZE:
-                print(f"⚠️ Image too large ({len(file_content)} bytes), skipping OCR")
+            image_file = TextExtractor._as_file(file_content)
+            file_size = image_file.seek(0, os.SEEK_END)
+            image_file.seek(0)
+            if file_size > MAX_IMAGE_SIZE:
+                logger.warning("⚠️ Image too large (%s bytes), skipping OCR", file_size)
                 return None
             
-            # Create a file-like object from bytes
-            image_file = io.BytesIO(file_content)
-            
-            # Open and validate image
-            temp_image = None
+            # Open and validate image. Image.open only parses the header, so the
+            # dimension check below runs before any pixel data is decoded; load()
+            # then decodes (and thereby validates) the image in a single pass
             try:
-                temp_image = Image.open(image_file)
-                
-                # Verify image can be loaded
-                temp_image.verify()
-                temp_image.close()  # Close after verify
-                temp_image = None
-                
-                # Reopen image after verify (verify closes it)
-                image_file.seek(0)
                 image = Image.open(image_file)
                 
                 # Check image dimensions (skip very large images that might cause OCR issues)
                 MAX_DIMENSION = 10000
                 if image.width > MAX_DIMENSION or image.height > MAX_DIMENSION:
-                    print(f"⚠️ Image dimensions too large ({image.width}x{image.height}), skipping OCR")
+                    logger.warning("⚠️ Image dimensions too large (%sx%s), skipping OCR", image.width, image.height)
                     image.close()
                     return None
                 
+                image.load()
+                
                 # Convert to RGB if needed (some formats cause issues)
                 if image.mode not in ('RGB', 'L'):
-                    image = image.convert('RGB')
+                    converted = image.convert('RGB')
+                    image.close()
+                    image = converted
                     
             except Exception as img_error:
-                print(f"⚠️ Invalid or corrupted image file: {str(img_error)}")
-                # Clean up temp_image if it's still open
-                if temp_image:
-                    try:
-                        temp_image.close()
-                    except:
-                        pass
+                logger.warning("⚠️ Invalid or corrupted image file: %s", img_error)
                 # Clean up image if it's open
                 if image:
                     try:
@@ -117,7 +156,7 @@ class TextExtractor:
             try:
                 text = pytesseract.image_to_string(image)
             except Exception as ocr_error:
-                print(f"⚠️ OCR failed for image: {str(ocr_error)}")
+                logger.warning("⚠️ OCR failed for image: %s", ocr_error)
                 return None
             finally:
                 # Clean up
@@ -128,13 +167,13 @@ class TextExtractor:
                         pass
             
             if not text or not text.strip():
-                print("⚠️ No text detected in image (might be blank or low quality)")
+                logger.warning("⚠️ No text detected in image (might be blank or low quality)")
                 return None
             
             return text.strip()
             
         except Exception as e:
-            print(f"❌ Error extracting text from image: {str(e)}")
+            logger.error("❌ Error extracting text from image: %s", e)
             if image:
                 try:
                     image.close()
@@ -143,28 +182,35 @@ class TextExtractor:
             return None
     
     @staticmethod
-    def extract_from_text(file_content: bytes) -> Optional[str]:
+    def extract_from_text(file_content: Union[bytes, BinaryIO]) -> Optional[str]:
         """
         Extract text from plain text file
         
         Args:
-            file_content: Raw bytes of the text file
+            file_content: Raw bytes or binary file object of the text file
             
         Returns:
             Decoded text or None if decoding fails
         """
         try:
-            # Try UTF-8 first
+            if not isinstance(file_content, (bytes, bytearray)):
+                file_content = TextExtractor._as_file(file_content).read()
+            
+            # Try UTF-8 first (the common case, no detection cost)
             try:
                 return file_content.decode('utf-8')
             except UnicodeDecodeError:
-                # Fallback to latin-1
-                try:
-                    return file_content.decode('latin-1')
-                except UnicodeDecodeError:
-                    print("⚠️ Could not decode text file with UTF-8 or Latin-1")
-                    return None
+                pass
+            
+            # Detect the actual encoding (CP1252, Shift-JIS, UTF-16, ...) instead
+            # of assuming Latin-1, which decodes anything but garbles most of it
+            match = from_bytes(bytes(file_content)).best()
+            if match is not None:
+                return str(match)
+            
+            # Last resort: Latin-1 maps every byte, so text is never dropped
+            return file_content.decode('latin-1')
                     
         except Exception as e:
-            print(f"❌ Error extracting text: {str(e)}")
+            logger.error("❌ Error extracting text: %s", e)
             return None
@@ -1,19 +1,80 @@
 import re
+import ipaddress
+import socket
 import requests
 from bs4 import BeautifulSoup
 from typing import List, Dict, Optional
-from urllib.parse import urlparse
-import sys
+from urllib.parse import urljoin, urlparse
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
+
+logger = logging.getLogger(__name__)
+
+# lxml's C parser is several times faster than the pure-Python html.parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
 class WebContentService:
     """Service for detecting URLs in text and fetching web content"""
     
     MAX_URLS_PER_QUERY = 2
     MAX_CONTENT_SIZE = 1_000_000  # 1MB
+    READ_CHUNK_SIZE = 64 * 1024  # Decoded bytes per streamed read
+    MAX_TEXT_CHARS = 10_000  # Page text kept per URL
     TIMEOUT_SECONDS = 10
+    MAX_REDIRECTS = 5  # Redirect hops followed, each re-validated
+    MAX_FETCH_WORKERS = 8
+    CACHE_SIZE = 256  # Fetched pages kept in memory
+    CACHE_TTL_SECONDS = 900  # Re-fetch a page after 15 minutes
+    FAILURE_CACHE_SIZE = 512  # Recently failed URLs remembered
+    FAILURE_TTL_SECONDS = 120  # Retry a failed URL after 2 minutes
+    
+    # Every encoding urllib3 can decode here: gzip and deflate, plus br when brotli is installed
+    ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+    
+    # Shared HTTP session so TCP/TLS connections are reused across fetches
+    _session: Optional[requests.Session] = None
+    _session_lock = threading.Lock()
+    
+    # url -> (fetched_at, content dict), oldest first
+    _cache: "OrderedDict[str, tuple]" = OrderedDict()
+    _cache_lock = threading.Lock()
+    _cache_hits = 0
+    _cache_misses = 0
+    # url -> (failed_at, reason); kept apart so failures expire much sooner
+    _failures: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    # URL regex pattern, compiled once at import. A single character class
+    # matches as a bitmap test; the $-_ range spans ASCII 0x24-0x5F, which
+    # covers the path/query punctuation (: / ; = ? # ...) and '%' escapes
+    URL_PATTERN = re.compile(r'https?://[a-zA-Z0-9$-_@.&+!*(),]+', re.ASCII)
+    
+    # Runs of whitespace (including newlines) collapsed to one space in page text
+    WHITESPACE_PATTERN = re.compile(r'\s+')
+    
+    # Blocked domains for security; a blocked domain also blocks its subdomains
+    BLOCKED_HOSTS = frozenset({'localhost'})
     
-    # Blocked domains for security
-    BLOCKED_DOMAINS = ['localhost', '127.0.0.1', '0.0.0.0']
+    @staticmethod
+    def find_urls(text: str) -> List[str]:
+        """
+        Find every unique URL in text, in order of first appearance.
+        Used at ingest time so chunk URLs are stored rather than rescanned per query.
+        """
+        # Most text has no URL at all; a substring check is far cheaper than the regex scan
+        if 'http' not in text:
+            return []
+        
+        # dict preserves insertion order, so this removes duplicates in order
+        return list(dict.fromkeys(WebContentService.URL_PATTERN.findall(text)))
     
     @staticmethod
     def detect_urls(text: str) -> List[str]:
@@ -21,80 +82,224 @@ class WebContentService:
         Detect URLs in text using regex.
         Returns list of unique URLs found (max MAX_URLS_PER_QUERY).
         """
-        # URL regex pattern
-        url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        
-        urls = re.findall(url_pattern, text)
-        
-        # Remove duplicates while preserving order
-        unique_urls = []
-        seen = set()
-        for url in urls:
-            if url not in seen:
-                unique_urls.append(url)
-                seen.add(url)
-        
         # Limit to MAX_URLS_PER_QUERY
-        return unique_urls[:WebContentService.MAX_URLS_PER_QUERY]
+        return WebContentService.find_urls(text)[:WebContentService.MAX_URLS_PER_QUERY]
     
     @staticmethod
     def is_url_allowed(url: str) -> bool:
         """Check if URL is allowed (not blocked)"""
         try:
-            parsed = urlparse(url)
-            domain = parsed.netloc.lower()
+            # hostname is lowercased and excludes any port or credentials
+            hostname = urlparse(url).hostname
+            if not hostname:
+                return False
             
-            # Check against blocked domains
-            for blocked in WebContentService.BLOCKED_DOMAINS:
-                if blocked in domain:
+            # One set lookup per parent domain (a.b.example -> b.example -> example),
+            # so the cost depends on label count, not blocklist size
+            labels = hostname.rstrip('.').split('.')
+            for i in range(len(labels)):
+                if '.'.join(labels[i:]) in WebContentService.BLOCKED_HOSTS:
                     return False
             
+            # Check every address the host resolves to, so integer or hex IPs
+            # (http://2130706433/) and DNS names pointing at 127.0.0.1 are caught
+            # too. Unresolvable hosts are rejected; the fetch would fail anyway.
+            try:
+                addresses = socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP)
+            except (socket.gaierror, UnicodeError):
+                return False
+            for *_, sockaddr in addresses:
+                ip = ipaddress.ip_address(sockaddr[0].split('%', 1)[0])
+                ip = getattr(ip, 'ipv4_mapped', None) or ip  # ::ffff:127.0.0.1
+                if ip.is_loopback or ip.is_private or ip.is_link_local or ip.is_unspecified:
+                    return False
             return True
         except Exception:
             return False
     
+    @staticmethod
+    def _get_session() -> requests.Session:
+        """Return the shared HTTP session, creating it on first use"""
+        with WebContentService._session_lock:
+            if WebContentService._session is None:
+                session = requests.Session()
+                session.headers.update({
+                    'User-Agent': 'Mozilla/5.0 (compatible; RAG-Chatbot/1.0)'
+                })
+                # One quick retry absorbs dropped keep-alive connections
+                adapter = HTTPAdapter(
+                    pool_connections=WebContentService.MAX_FETCH_WORKERS,
+                    pool_maxsize=WebContentService.MAX_FETCH_WORKERS,
+                    max_retries=Retry(total=1, backoff_factor=0.2)
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                WebContentService._session = session
+            return WebContentService._session
+    
+    @staticmethod
+    def _open(url: str, headers: Dict[str, str]) -> Optional[requests.Response]:
+        """
+        GET a URL as a stream, following redirects one hop at a time.
+        
+        The session is not left to follow redirects itself: every Location is
+        checked with is_url_allowed first, so a public page cannot bounce the
+        fetch to a loopback, private or link-local address. Returns None if a
+        redirect target is blocked.
+        """
+        session = WebContentService._get_session()
+        for _ in range(WebContentService.MAX_REDIRECTS + 1):
+            response = session.get(
+                url,
+                headers=headers,
+                timeout=WebContentService.TIMEOUT_SECONDS,
+                stream=True,
+                allow_redirects=False
+            )
+            if not response.is_redirect:
+                return response
+            
+            location = urljoin(url, response.headers['Location'])
+            response.close()
+            if not WebContentService.is_url_allowed(location):
+                logger.warning("⚠️ Blocked redirect from %s to %s", url, location)
+                return None
+            url = location
+        
+        raise requests.TooManyRedirects(f"more than {WebContentService.MAX_REDIRECTS} redirects")
+    
+    @staticmethod
+    def _cache_get(url: str) -> Optional[Dict[str, str]]:
+        """Return a cached fetch result that is still within its TTL"""
+        with WebContentService._cache_lock:
+            entry = WebContentService._cache.get(url)
+            if entry is not None and time.monotonic() - entry[0] > WebContentService.CACHE_TTL_SECONDS:
+                del WebContentService._cache[url]
+                entry = None
+            if entry is None:
+                WebContentService._cache_misses += 1
+                return None
+            WebContentService._cache_hits += 1
+            WebContentService._cache.move_to_end(url)
+            return entry[1]
+    
+    @staticmethod
+    def _cache_put(url: str, content: Dict[str, str]):
+        """Cache a successful fetch, evicting the least recently used page"""
+        with WebContentService._cache_lock:
+            WebContentService._cache[url] = (time.monotonic(), content)
+            WebContentService._cache.move_to_end(url)
+            if len(WebContentService._cache) > WebContentService.CACHE_SIZE:
+                WebContentService._cache.popitem(last=False)
+    
+    @staticmethod
+    def _failure_get(url: str) -> Optional[str]:
+        """Return the reason a URL failed within FAILURE_TTL_SECONDS, if it did"""
+        with WebContentService._cache_lock:
+            entry = WebContentService._failures.get(url)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > WebContentService.FAILURE_TTL_SECONDS:
+                del WebContentService._failures[url]
+                return None
+            return entry[1]
+    
+    @staticmethod
+    def _failure_put(url: str, reason: str):
+        """Remember a failed fetch so repeat references don't wait on it again"""
+        with WebContentService._cache_lock:
+            WebContentService._failures[url] = (time.monotonic(), reason)
+            WebContentService._failures.move_to_end(url)
+            if len(WebContentService._failures) > WebContentService.FAILURE_CACHE_SIZE:
+                WebContentService._failures.popitem(last=False)
+    
+    @staticmethod
+    def invalidate(url: str) -> bool:
+        """Drop a URL from the fetch and failure caches. Returns True if it was cached."""
+        with WebContentService._cache_lock:
+            failed = WebContentService._failures.pop(url, None) is not None
+            return WebContentService._cache.pop(url, None) is not None or failed
+    
+    @staticmethod
+    def cache_stats() -> Dict[str, int]:
+        """Return fetch cache size and hit/miss counters"""
+        with WebContentService._cache_lock:
+            return {
+                'size': len(WebContentService._cache),
+                'hits': WebContentService._cache_hits,
+                'misses': WebContentService._cache_misses
+            }
+    
     @staticmethod
     def fetch_url_content(url: str) -> Optional[Dict[str, str]]:
         """
         Fetch content from a URL and extract readable text.
         Returns dict with 'url', 'title', and 'content' keys, or None if failed.
+        Successful results are cached for CACHE_TTL_SECONDS.
         """
         try:
+            # Caches first: only allowed URLs are ever cached, and blocked ones
+            # land in the failure cache, so repeat references skip the DNS lookup
+            cached = WebContentService._cache_get(url)
+            if cached is not None:
+                logger.debug("⚡ Using cached content for: %s", url)
+                return cached
+            
+            failure = WebContentService._failure_get(url)
+            if failure is not None:
+                logger.debug("⚡ Skipping %s, it failed recently (%s)", url, failure)
+                return None
+            
             # Validate URL
             if not WebContentService.is_url_allowed(url):
-                print(f"⚠️ Blocked URL: {url}", file=sys.stderr)
+                logger.warning("⚠️ Blocked URL: %s", url)
+                WebContentService._failure_put(url, "blocked")
                 return None
             
-            print(f"🔗 Fetching content from: {url}", file=sys.stderr)
+            logger.info("🔗 Fetching content from: %s", url)
             
             # Fetch with timeout and size limit
             headers = {
-                'User-Agent': 'Mozilla/5.0 (compatible; RAG-Chatbot/1.0)'
+                'Accept': 'text/html,text/plain;q=0.9',
+                'Accept-Encoding': WebContentService.ACCEPT_ENCODING
             }
             
-            response = requests.get(
-                url,
-                headers=headers,
-                timeout=WebContentService.TIMEOUT_SECONDS,
-                stream=True
-            )
-            
-            # Check content type
-            content_type = response.headers.get('Content-Type', '').lower()
-            if 'text/html' not in content_type and 'text/plain' not in content_type:
-                print(f"⚠️ Unsupported content type: {content_type}", file=sys.stderr)
+            response = WebContentService._open(url, headers)
+            if response is None:
+                WebContentService._failure_put(url, "redirect to blocked URL")
                 return None
             
-            # Read content with size limit
-            content_bytes = b''
-            for chunk in response.iter_content(chunk_size=8192):
-                content_bytes += chunk
-                if len(content_bytes) > WebContentService.MAX_CONTENT_SIZE:
-                    print(f"⚠️ Content too large (>{WebContentService.MAX_CONTENT_SIZE} bytes)", file=sys.stderr)
-                    break
+            # The with-block returns the connection to the session's pool
+            with response:
+                # Check content type
+                content_type = response.headers.get('Content-Type', '').lower()
+                if 'text/html' not in content_type and 'text/plain' not in content_type:
+                    logger.warning("⚠️ Unsupported content type: %s", content_type)
+                    WebContentService._failure_put(url, f"unsupported content type {content_type}")
+                    return None
+                
+                # Skip pages that declare an oversized body before downloading any of it
+                content_length = response.headers.get('Content-Length', '')
+                if content_length.isdigit() and int(content_length) > WebContentService.MAX_CONTENT_SIZE:
+                    logger.warning("⚠️ Content too large (%s bytes), skipping", content_length)
+                    WebContentService._failure_put(url, "content too large")
+                    return None
+                
+                # Stream the body as decoded READ_CHUNK_SIZE chunks into a bytearray
+                # (extended in place, unlike repeated bytes +=) and stop once it
+                # passes MAX_CONTENT_SIZE, so a small compressed body cannot
+                # inflate past the cap; the excess is trimmed off
+                body = bytearray()
+                for chunk in response.iter_content(chunk_size=WebContentService.READ_CHUNK_SIZE):
+                    body.extend(chunk)
+                    if len(body) > WebContentService.MAX_CONTENT_SIZE:
+                        logger.warning("⚠️ Content too large (>%d bytes)", WebContentService.MAX_CONTENT_SIZE)
+                        del body[WebContentService.MAX_CONTENT_SIZE:]
+                        break
+                content_bytes = bytes(body)
             
             # Parse HTML
-            soup = BeautifulSoup(content_bytes, 'html.parser')
+            soup = BeautifulSoup(content_bytes, HTML_PARSER)
             
             # Remove script and style elements
             for script in soup(['script', 'style', 'nav', 'footer', 'header']):
@@ -103,42 +308,57 @@ class WebContentService:
             # Extract title
             title = soup.title.string if soup.title else url
             
-            # Extract text content
-            text = soup.get_text(separator=' ', strip=True)
-            
-            # Clean up whitespace
-            lines = (line.strip() for line in text.splitlines())
-            text = ' '.join(line for line in lines if line)
+            # Extract text content with whitespace collapsed, stopping once past
+            # the text budget instead of walking the rest of the tree
+            parts = []
+            length = 0
+            for string in soup.stripped_strings:
+                string = WebContentService.WHITESPACE_PATTERN.sub(' ', string)
+                parts.append(string)
+                length += len(string) + 1
+                if length > WebContentService.MAX_TEXT_CHARS:
+                    break
+            text = ' '.join(parts)
             
             # Limit text length
-            if len(text) > 10000:
-                text = text[:10000] + "..."
+            if len(text) > WebContentService.MAX_TEXT_CHARS:
+                text = text[:WebContentService.MAX_TEXT_CHARS] + "..."
             
-            print(f"✅ Fetched {len(text)} characters from {url}", file=sys.stderr)
+            logger.info("✅ Fetched %d characters from %s", len(text), url)
             
-            return {
+            content = {
                 'url': url,
                 'title': str(title).strip(),
                 'content': text
             }
+            WebContentService._cache_put(url, content)
+            return content
             
         except requests.Timeout:
-            print(f"⚠️ Timeout fetching {url}", file=sys.stderr)
+            logger.warning("⚠️ Timeout fetching %s", url)
+            WebContentService._failure_put(url, "timeout")
             return None
         except Exception as e:
-            print(f"⚠️ Error fetching {url}: {str(e)}", file=sys.stderr)
+            logger.warning("⚠️ Error fetching %s: %s", url, e)
+            WebContentService._failure_put(url, type(e).__name__)
             return None
     
     @staticmethod
     def fetch_all_urls(urls: List[str]) -> List[Dict[str, str]]:
         """
-        Fetch content from multiple URLs.
-        Returns list of successfully fetched content dicts.
+        Fetch content from multiple URLs concurrently.
+        Returns list of successfully fetched content dicts, in input order.
         """
-        results = []
-        for url in urls:
-            content = WebContentService.fetch_url_content(url)
-            if content:
-                results.append(content)
+        if not urls:
+            return []
+        
+        # A URL repeated by the caller is fetched once
+        urls = list(dict.fromkeys(urls))
+        
+        # Fetches are network-bound, so threads overlap the round trips and
+        # wall time is the slowest URL rather than the sum of all of them
+        max_workers = min(len(urls), WebContentService.MAX_FETCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            contents = list(executor.map(WebContentService.fetch_url_content, urls))
         
-        return results
+        return [content for content in contents if content]